@@ -1,16 +1,27 @@
 import streamlit as st
 from datetime import datetime
 import pandas as pd
-from io import BytesIO
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import A4
-import qrcode
+from io import BytesIO, TextIOWrapper
+import csv
+import receipt_engine  # Light: reportlab is imported on the first render
 import urllib.parse
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from itertools import groupby
+import os
+import sqlite3
+import threading
+import random
+import zlib
+import argparse
+import functools
+import json
+import uuid
+import socket
+import re
+import difflib
+from bisect import bisect_left
 
 # ================= UI CONFIG =================
 st.set_page_config(
@@ -78,40 +89,328 @@ st.markdown("""
 
 # ================= CACHING SETUP =================
 
-# Initialize cache in session state
-if 'cache_timestamp' not in st.session_state:
-    st.session_state.cache_timestamp = {}
-    st.session_state.cached_data = {}
+CACHE_DURATION = 30  # Data older than this is served stale while it is refreshed
+CACHE_MAX_ENTRIES = 32
 
-CACHE_DURATION = 30  # Cache data for 30 seconds
+class SharedDataCache:
+    """Process-wide LRU cache shared by every session, with per-key version counters"""
 
-def is_cache_valid(key):
-    """Check if cache is still valid"""
-    if key not in st.session_state.cache_timestamp:
-        return False
-    return (time.time() - st.session_state.cache_timestamp[key]) < CACHE_DURATION
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_DURATION):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()  # key -> (data, timestamp)
+        self._derived = OrderedDict()  # key -> (versions, value), see memo()
+        self._versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+
+    def version(self, key):
+        """Current version of a key; bumped on every invalidation"""
+        with self._lock:
+            return self._versions.get(key, 0)
+
+    def get(self, key):
+        """Return cached data, or None on miss.
+
+        Entries older than the TTL are still returned (stale-while-revalidate);
+        the refresh worker renews them in the background.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            if (time.time() - entry[1]) >= self.ttl:
+                self.stale_hits += 1
+            return entry[0]
+
+    def age(self, key):
+        """Seconds since the entry was loaded (None if not cached)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return time.time() - entry[1] if entry else None
+
+    def touch(self, key):
+        """Mark an entry as freshly revalidated"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (entry[0], time.time())
+
+    def set(self, key, data, version=None):
+        """Store data; skipped if the key was invalidated since `version` was read"""
+        with self._lock:
+            if version is not None and version != self._versions.get(key, 0):
+                return False
+            self._entries[key] = (data, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def patch(self, key, update):
+        """Replace a cached entry with update(data) instead of refetching; bumps the version"""
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            self._entries[key] = (update(entry[0]), entry[1])
+            return True
+
+    def memo(self, key, versions, build):
+        """Return build() memoised until any of `versions` changes (a None result is not kept)"""
+        with self._lock:
+            entry = self._derived.get(key)
+            if entry is not None and entry[0] == versions:
+                self._derived.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = build()
+        if value is None:
+            return None
+        with self._lock:
+            self._derived[key] = (versions, value)
+            self._derived.move_to_end(key)
+            while len(self._derived) > self.max_entries:
+                self._derived.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def invalidate(self, key):
+        """Drop one key and bump its version"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._versions[key] = self._versions.get(key, 0) + 1
+
+    def clear(self):
+        """Drop everything, bumping every known version"""
+        with self._lock:
+            for key in set(self._entries) | set(self._versions):
+                self._versions[key] = self._versions.get(key, 0) + 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale_hits': self.stale_hits,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'versions': dict(self._versions),
+            }
+
+@st.cache_resource
+def get_shared_cache():
+    """One cache per server process"""
+    return SharedDataCache()
+
+shared_cache = get_shared_cache()
 
 def get_cached_data(key):
     """Get data from cache"""
-    if is_cache_valid(key):
-        return st.session_state.cached_data[key]
-    return None
+    return shared_cache.get(key)
 
-def set_cached_data(key, data):
+def set_cached_data(key, data, version=None):
     """Store data in cache"""
-    st.session_state.cached_data[key] = data
-    st.session_state.cache_timestamp[key] = time.time()
+    return shared_cache.set(key, data, version)
+
+def invalidate_cache(*sheet_names):
+    """Invalidate only the given sheets (bumps their versions for every session)"""
+    for sheet_name in sheet_names:
+        shared_cache.invalidate(f"data_{sheet_name}")
+
+def cache_append_rows(sheet_name, rows):
+    """Patch freshly appended rows into the cached sheet (no refetch); returns the rows' new records"""
+    return cache_append_records(sheet_name, [dict(zip(SHEET_HEADERS[sheet_name], row)) for row in rows])
 
-def clear_cache():
-    """Clear all cached data"""
-    st.session_state.cache_timestamp = {}
-    st.session_state.cached_data = {}
+def cache_append_records(sheet_name, records):
+    """Patch appended records (dicts) into the cached sheet, skipping ids it already holds.
+
+    A session that cold-loads the sheet between a backend write and this patch
+    already has the row. Returns the records that were actually added (all of
+    them when the sheet is not cached).
+    """
+    added = list(records)
+    def update(data):
+        present = {str(r.get('id')) for r in data}
+        added[:] = [r for r in records if str(r.get('id')) not in present]
+        return data + added
+    shared_cache.patch(f"data_{sheet_name}", update)
+    return added
+
+def cache_delete_row(sheet_name, row_id):
+    """Remove a row from the cached sheet"""
+    shared_cache.patch(f"data_{sheet_name}",
+                       lambda data: [r for r in data if str(r.get('id')) != str(row_id)])
+
+def memoize(sheet_names, name, build):
+    """Memoise a value derived from some sheets, shared across sessions until their data changes"""
+    versions = tuple(shared_cache.version(f"data_{sheet_name}") for sheet_name in sheet_names)
+    return shared_cache.memo(f"{name}:{','.join(sheet_names)}", versions, build)
+
+# ================= TRACING =================
+
+TRACE_HISTORY = 50  # Recent reruns kept for the diagnostics page
+
+class Tracer:
+    """Span timings for each rerun plus process-wide per-span aggregates.
+
+    Spans cost two perf_counter calls and a dict update, so tracing stays on.
+    Spans outside a rerun (background threads, fragment reruns) only feed the aggregates.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.totals = {}  # span -> [count, seconds, max seconds]
+        self.remote_calls = defaultdict(int)
+        self.reruns = 0
+        self.runs = deque(maxlen=TRACE_HISTORY)
+
+    @contextmanager
+    def span(self, name, remote=False):
+        run = getattr(self._local, 'run', None)
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._local.depth = depth
+            with self._lock:
+                total = self.totals.setdefault(name, [0, 0.0, 0.0])
+                total[0] += 1
+                total[1] += elapsed
+                total[2] = max(total[2], elapsed)
+                if remote:
+                    self.remote_calls[name] += 1
+            if run is not None:
+                run['spans'].append((name, depth, (start - run['_start']) * 1000, elapsed * 1000))
+                run['remote_calls'] += remote
+
+    @contextmanager
+    def rerun(self, label="rerun"):
+        """Collect the spans, cache lookups and remote calls of one script run"""
+        before = shared_cache.stats()
+        run = {'label': label, 'started': time.time(), 'spans': [], 'remote_calls': 0,
+               '_start': time.perf_counter()}
+        self._local.run = run
+        try:
+            yield run
+        finally:
+            self._local.run = None
+            after = shared_cache.stats()
+            run['total_ms'] = (time.perf_counter() - run.pop('_start')) * 1000
+            run['cache_hits'] = after['hits'] - before['hits']
+            run['cache_misses'] = after['misses'] - before['misses']
+            run['spans'].sort(key=lambda span: span[2])
+            with self._lock:
+                self.reruns += 1
+                self.runs.append(run)
+
+    def span_table(self):
+        """Aggregates as rows of span, calls, total/mean/max ms (slowest total first)"""
+        with self._lock:
+            rows = [{'span': name, 'calls': count, 'total_ms': seconds * 1000,
+                     'mean_ms': seconds * 1000 / count, 'max_ms': peak * 1000}
+                    for name, (count, seconds, peak) in self.totals.items()]
+        return sorted(rows, key=lambda row: -row['total_ms'])
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'reruns': self.reruns,
+                'spans': {name: {'calls': c, 'seconds': sec, 'max_seconds': peak}
+                          for name, (c, sec, peak) in self.totals.items()},
+                'remote_calls': dict(self.remote_calls),
+                'recent_runs': list(self.runs),
+                'cache': {k: v for k, v in shared_cache.stats().items() if k != 'versions'},
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, default=str)
+
+    def to_prometheus(self):
+        """Prometheus text exposition format"""
+        snap = self.snapshot()
+        lines = [
+            "# TYPE coaching_erp_reruns_total counter",
+            f"coaching_erp_reruns_total {snap['reruns']}",
+            "# TYPE coaching_erp_span_seconds summary",
+        ]
+        for name, span in sorted(snap['spans'].items()):
+            lines.append(f'coaching_erp_span_seconds_count{{span="{name}"}} {span["calls"]}')
+            lines.append(f'coaching_erp_span_seconds_sum{{span="{name}"}} {span["seconds"]:.6f}')
+        lines.append("# TYPE coaching_erp_span_max_seconds gauge")
+        for name, span in sorted(snap['spans'].items()):
+            lines.append(f'coaching_erp_span_max_seconds{{span="{name}"}} {span["max_seconds"]:.6f}')
+        lines.append("# TYPE coaching_erp_remote_calls_total counter")
+        for name, count in sorted(snap['remote_calls'].items()):
+            lines.append(f'coaching_erp_remote_calls_total{{call="{name}"}} {count}')
+        for key in ('hits', 'misses', 'stale_hits', 'evictions'):
+            lines.append(f"# TYPE coaching_erp_cache_{key}_total counter")
+            lines.append(f"coaching_erp_cache_{key}_total {snap['cache'][key]}")
+        lines.append("# TYPE coaching_erp_cache_entries gauge")
+        lines.append(f"coaching_erp_cache_entries {snap['cache']['entries']}")
+        return "\n".join(lines) + "\n"
+
+@st.cache_resource
+def init_tracer():
+    """One tracer per server process"""
+    return Tracer()
+
+tracer = init_tracer()
+
+def traced(name=None, remote=False):
+    """Decorator recording each call as a span (remote=True also counts it as a network call)"""
+    def decorate(func):
+        label = name or func.__name__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(label, remote):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+# ================= SETTINGS =================
+
+SHEET_HEADERS = {
+    'students': ['id', 'name', 'phone', 'course', 'fee', 'paid', 'status', 'date'],
+    'payments': ['id', 'student_id', 'amount', 'mode', 'date'],
+    'expenses': ['id', 'title', 'amount', 'category', 'date'],
+    'investments': ['id', 'investor', 'amount', 'date', 'notes']
+}
+SHEET_NAMES = list(SHEET_HEADERS)
+
+def get_setting(key, default=None):
+    """Read a setting from st.secrets, falling back to COACHING_ERP_<KEY> env vars"""
+    try:
+        if key in st.secrets:
+            return st.secrets[key]
+    except Exception:
+        pass
+    return os.environ.get(f"COACHING_ERP_{key.upper()}", default)
 
 # ================= GOOGLE SHEETS SETUP =================
 
 @st.cache_resource(ttl=3600)  # Cache for 1 hour
+@traced("sheets.connect", remote=True)
 def init_google_sheets():
     """Initialize Google Sheets connection with caching"""
+    import gspread  # Only deployments with a service account pay for these imports
+    from oauth2client.service_account import ServiceAccountCredentials
     try:
         credentials_dict = dict(st.secrets["gcp_service_account"])
         scope = [
@@ -123,22 +422,13 @@ def init_google_sheets():
         spreadsheet_id = st.secrets["spreadsheet_id"]
         spreadsheet = client.open_by_key(spreadsheet_id)
         
-        # Initialize sheets
-        sheet_names = ['students', 'payments', 'expenses', 'investments']
-        headers = {
-            'students': ['id', 'name', 'phone', 'course', 'fee', 'paid', 'status', 'date'],
-            'payments': ['id', 'student_id', 'amount', 'mode', 'date'],
-            'expenses': ['id', 'title', 'amount', 'category', 'date'],
-            'investments': ['id', 'investor', 'amount', 'date', 'notes']
-        }
-        
         sheets = {}
-        for name in sheet_names:
+        for name, headers in SHEET_HEADERS.items():
             try:
                 sheet = spreadsheet.worksheet(name)
             except:
                 sheet = spreadsheet.add_worksheet(title=name, rows="1000", cols="10")
-                sheet.update('A1', [headers[name]])
+                sheet.update('A1', [headers])
             sheets[name] = sheet
         
         return sheets
@@ -146,10 +436,1245 @@ def init_google_sheets():
         st.error(f"Error connecting to Google Sheets: {e}")
         return None
 
-sheets = init_google_sheets()
+# ================= STORAGE BACKENDS =================
+
+class StorageBackend:
+    """Interface behind get_all_data / add_* / delete_row"""
+    name = "base"
+
+    def fetch_all(self, sheet_name):
+        """Return every row of a sheet as a list of dicts"""
+        raise NotImplementedError
+
+    def fetch_many(self, sheet_names):
+        """{sheet_name: rows} for several sheets, as one consistent read where the store allows"""
+        return {sheet_name: self.fetch_all(sheet_name) for sheet_name in sheet_names}
+
+    def write_batch(self, appends=(), updates=(), increments=()):
+        """Apply several writes in one round trip.
+
+        appends:    (sheet_name, row) with row in SHEET_HEADERS order
+        updates:    (sheet_name, row_id, column, value)
+        increments: (sheet_name, row_id, column, delta)
+        Returns {(sheet_name, row_id, column): new_value} for each applied increment.
+        """
+        raise NotImplementedError
+
+    def delete_row(self, sheet_name, row_id, increments=()):
+        """Delete the row with the given id, returning True if it existed.
+
+        increments are applied with the delete, and only when the row existed.
+        """
+        raise NotImplementedError
+
+    def reserve_ids(self, sheet_name, count=1):
+        """Atomically reserve `count` consecutive ids, returned as a range"""
+        raise NotImplementedError
+
+    def append_row(self, sheet_name, row):
+        self.write_batch(appends=[(sheet_name, row)])
+
+    def append_rows(self, sheet_name, rows):
+        self.write_batch(appends=[(sheet_name, row) for row in rows])
+
+    def update_value(self, sheet_name, row_id, column, value):
+        self.write_batch(updates=[(sheet_name, row_id, column, value)])
+
+    def increment_value(self, sheet_name, row_id, column, delta):
+        """Add delta to a numeric column, returning the new value (None if row missing)"""
+        results = self.write_batch(increments=[(sheet_name, row_id, column, delta)])
+        return results.get((sheet_name, row_id, column))
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _check_column(sheet_name, column):
+    if column not in SHEET_HEADERS[sheet_name]:
+        raise ValueError(f"Unknown column {column!r} for {sheet_name}")
+    return column
+
+
+class SQLiteBackend(StorageBackend):
+    """Local SQLite store (WAL mode, indexed on id / student_id / date)"""
+    name = "sqlite"
+
+    SCHEMA = {
+        'students': "id INTEGER PRIMARY KEY, name TEXT, phone TEXT, course TEXT, "
+                    "fee REAL, paid REAL DEFAULT 0, status TEXT DEFAULT 'active', date TEXT",
+        'payments': "id INTEGER PRIMARY KEY, student_id INTEGER, amount REAL, mode TEXT, date TEXT",
+        'expenses': "id INTEGER PRIMARY KEY, title TEXT, amount REAL, category TEXT, date TEXT",
+        'investments': "id INTEGER PRIMARY KEY, investor TEXT, amount REAL, date TEXT, notes TEXT",
+    }
+    INDEXES = [
+        "CREATE INDEX IF NOT EXISTS idx_students_date ON students(date)",
+        "CREATE INDEX IF NOT EXISTS idx_students_course ON students(course)",
+        "CREATE INDEX IF NOT EXISTS idx_students_status ON students(status)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_mode ON payments(mode)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_student_id ON payments(student_id)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_date ON payments(date)",
+        "CREATE INDEX IF NOT EXISTS idx_expenses_date ON expenses(date)",
+        "CREATE INDEX IF NOT EXISTS idx_investments_date ON investments(date)",
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.track_writes = False  # Set by a ClusterChannel, which consumes _own
+        self._own = defaultdict(set)  # table -> versions produced by this process
+        self._own_lock = threading.Lock()
+        with self.connection() as conn:
+            for table, columns in self.SCHEMA.items():
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns})")
+            for statement in self.INDEXES:
+                conn.execute(statement)
+            conn.execute("CREATE TABLE IF NOT EXISTS id_sequence (name TEXT PRIMARY KEY, next_id INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS table_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "key TEXT UNIQUE NOT NULL, op TEXT NOT NULL, created REAL NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT)"
+            )
+
+    def connection(self):
+        """Per-thread connection (Streamlit runs each session on its own thread)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def fetch_all(self, sheet_name):
+        columns = ", ".join(SHEET_HEADERS[sheet_name])
+        rows = self.connection().execute(f"SELECT {columns} FROM {sheet_name} ORDER BY id")
+        return [dict(row) for row in rows]
+
+    def fetch_many(self, sheet_names):
+        """All tables from one read transaction, so the frames agree with each other"""
+        conn = self.connection()
+        conn.execute("BEGIN")
+        try:
+            return {sheet_name: self.fetch_all(sheet_name) for sheet_name in sheet_names}
+        finally:
+            conn.execute("COMMIT")
+
+    def write_batch(self, appends=(), updates=(), increments=(), journal=False):
+        """journal=True also queues the resolved writes in the outbox, in the same transaction"""
+        appends, updates = list(appends), list(updates)
+        bumped = {}
+        with self.connection() as conn:  # One transaction for the whole batch
+            for sheet_name, rows in groupby(appends, key=lambda op: op[0]):
+                headers = SHEET_HEADERS[sheet_name]
+                conn.executemany(
+                    f"INSERT INTO {sheet_name} ({', '.join(headers)}) "
+                    f"VALUES ({', '.join('?' * len(headers))})",
+                    [list(row) for _, row in rows]
+                )
+            for sheet_name, row_id, column, value in updates:
+                column = _check_column(sheet_name, column)
+                conn.execute(f"UPDATE {sheet_name} SET {column} = ? WHERE id = ?", (value, row_id))
+            results = self._increment(conn, increments)
+            bumped = self._bump(conn, {op[0] for op in appends} | self._versioned(updates + list(increments)))
+            if journal:
+                # The mirror receives resolved values so it never has to read before writing
+                resolved = [list(key) + [value] for key, value in results.items()]
+                self._enqueue(conn, {
+                    'appends': [[sheet_name, list(row)] for sheet_name, row in appends],
+                    'updates': [list(op) for op in updates] + resolved,
+                })
+        self._committed(bumped)
+        return results
+
+    def delete_row(self, sheet_name, row_id, increments=(), journal=False):
+        bumped = {}
+        with self.connection() as conn:
+            cursor = conn.execute(f"DELETE FROM {sheet_name} WHERE id = ?", (row_id,))
+            if cursor.rowcount > 0:
+                results = self._increment(conn, increments)
+                bumped = self._bump(conn, {sheet_name} | self._versioned(increments))
+                if journal:
+                    self._enqueue(conn, {'delete': [sheet_name, row_id],
+                                         'updates': [list(key) + [value] for key, value in results.items()]})
+        self._committed(bumped)
+        return cursor.rowcount > 0
+
+    def _increment(self, conn, increments):
+        """Apply (sheet, id, column, delta) ops; returns {(sheet, id, column): new value}"""
+        results = {}
+        for sheet_name, row_id, column, delta in increments:
+            column = _check_column(sheet_name, column)
+            conn.execute(
+                f"UPDATE {sheet_name} SET {column} = COALESCE({column}, 0) + ? WHERE id = ?",
+                (delta, row_id)
+            )
+            row = conn.execute(f"SELECT {column} FROM {sheet_name} WHERE id = ?", (row_id,)).fetchone()
+            if row:
+                results[(sheet_name, row_id, column)] = row[0]
+        return results
+
+    # Stored columns that only mirror another table: writing them must not invalidate
+    # their own table across the cluster (students.paid follows the payments ledger,
+    # which is versioned itself, and nothing reads it through the students cache)
+    UNVERSIONED = {('students', 'paid')}
+
+    def _versioned(self, ops):
+        """Tables touched by (sheet, id, column, ...) ops, leaving out UNVERSIONED columns"""
+        return {op[0] for op in ops if (op[0], op[2]) not in self.UNVERSIONED}
+
+    def _bump(self, conn, sheet_names):
+        """Advance the persisted change counter of each table (inside the writing transaction).
+
+        Returns {table: new version}.
+        """
+        return {sheet_name: conn.execute(
+            "INSERT INTO table_versions (name, version) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET version = version + 1 RETURNING version",
+            (sheet_name,)
+        ).fetchone()[0] for sheet_name in sheet_names}
+
+    def _committed(self, bumped):
+        """Remember versions this process produced, so they are not mistaken for other writers'"""
+        if self.track_writes and bumped:
+            with self._own_lock:
+                for sheet_name, version in bumped.items():
+                    self._own[sheet_name].add(version)
+
+    def foreign_changes(self, seen):
+        """(current versions, tables another process changed since the `seen` versions)"""
+        current = self.table_versions()
+        changed = set()
+        with self._own_lock:
+            for sheet_name, version in current.items():
+                own = self._own.pop(sheet_name, set())
+                last = seen.get(sheet_name, 0)
+                if version < last or any(v not in own for v in range(last + 1, version + 1)):
+                    changed.add(sheet_name)
+                pending = {v for v in own if v > version}  # Committed after the read above
+                if pending:
+                    self._own[sheet_name] = pending
+        return current, changed
+
+    def acquire_lease(self, name, owner, ttl):
+        """Take or renew a named lease; True while `owner` holds it"""
+        now = time.time()
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+                "WHERE leases.owner = excluded.owner OR leases.expires < ?",
+                (name, owner, now + ttl, now)
+            )
+            row = conn.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()
+        return row['owner'] == owner
+
+    def table_versions(self):
+        """{table: change counter}; a table never written reads as 0"""
+        rows = self.connection().execute("SELECT name, version FROM table_versions")
+        return dict.fromkeys(SHEET_NAMES, 0) | {row['name']: row['version'] for row in rows}
+
+    # ---- Outbox: durable queue of writes still to be applied to the mirror ----
+
+    def _enqueue(self, conn, op):
+        # key is only a unique label; replays are safe because ops carry resolved values
+        conn.execute(
+            "INSERT INTO outbox (key, op, created) VALUES (?, ?, ?)",
+            (uuid.uuid4().hex, json.dumps(op, default=str), time.time())
+        )
+
+    def outbox_pending(self, limit, max_attempts):
+        """Oldest queued operations as (seq, op) pairs, skipping parked ones"""
+        rows = self.connection().execute(
+            "SELECT seq, op FROM outbox WHERE attempts < ? ORDER BY seq LIMIT ?", (max_attempts, limit)
+        )
+        return [(row['seq'], json.loads(row['op'])) for row in rows]
+
+    def outbox_ack(self, seqs):
+        with self.connection() as conn:
+            conn.executemany("DELETE FROM outbox WHERE seq = ?", [(seq,) for seq in seqs])
+
+    def outbox_fail(self, seqs, error):
+        with self.connection() as conn:
+            conn.executemany(
+                "UPDATE outbox SET attempts = attempts + 1, last_error = ? WHERE seq = ?",
+                [(str(error)[:500], seq) for seq in seqs]
+            )
+
+    def outbox_stats(self, max_attempts):
+        row = self.connection().execute(
+            "SELECT COUNT(*), SUM(attempts >= ?), MIN(created) FROM outbox", (max_attempts,)
+        ).fetchone()
+        return {'queued': row[0], 'parked': row[1] or 0,
+                'oldest_age': time.time() - row[2] if row[2] else 0.0}
+
+    def outbox_deleted_ids(self, sheet_name):
+        """Ids whose delete has not reached the mirror yet (sync must not re-import them)"""
+        rows = self.connection().execute("SELECT op FROM outbox WHERE op LIKE ?", (f'{{"delete": ["{sheet_name}"%',))
+        return {json.loads(row['op'])['delete'][1] for row in rows}
+
+    # Computed columns available to query()/count(); paid comes from the payments ledger
+    PAID_SQL = "(SELECT COALESCE(SUM(amount), 0) FROM payments WHERE payments.student_id = students.id)"
+    COMPUTED = {'students': {'paid': PAID_SQL, 'pending': f"fee - {PAID_SQL}"}}
+
+    def _where(self, sheet_name, filters):
+        """SQL WHERE clause for a filter dict.
+
+        Keys: a column name (scalar = equality, list = IN; an empty list matches nothing),
+        'search' (name/phone/title LIKE),
+        'date_from' / 'date_to' (YYYY-MM-DD, inclusive), '<column>_min' (strictly greater).
+        """
+        computed = self.COMPUTED.get(sheet_name, {})
+        clauses, params = [], []
+        for key, value in (filters or {}).items():
+            if value is None or (isinstance(value, str) and not value):
+                continue
+            if key == 'search':
+                text = [c for c in ('name', 'phone', 'title', 'investor') if c in SHEET_HEADERS[sheet_name]]
+                clauses.append("(" + " OR ".join(f"{c} LIKE ?" for c in text) + ")")
+                params += [f"%{value}%"] * len(text)
+            elif key in ('date_from', 'date_to'):
+                clauses.append("date >= ?" if key == 'date_from' else "date <= ?")
+                params.append(str(value))
+            elif key.endswith('_min'):
+                column = key[:-4]
+                expression = computed.get(column) or _check_column(sheet_name, column)
+                clauses.append(f"{expression} > ?")
+                params.append(value)
+            elif isinstance(value, (list, tuple, set)) and not value:
+                clauses.append("0")
+            elif isinstance(value, (list, tuple, set)) and len(value) > 500:
+                # One JSON parameter: SQLite caps the number of ? placeholders per statement
+                clauses.append(f"{_check_column(sheet_name, key)} IN (SELECT value FROM json_each(?))")
+                params.append(json.dumps(list(value), default=str))
+            elif isinstance(value, (list, tuple, set)):
+                clauses.append(f"{_check_column(sheet_name, key)} IN ({', '.join('?' * len(value))})")
+                params += list(value)
+            else:
+                clauses.append(f"{_check_column(sheet_name, key)} = ?")
+                params.append(value)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def count(self, sheet_name, filters=None):
+        """Number of rows matching filters"""
+        where, params = self._where(sheet_name, filters)
+        return self.connection().execute(f"SELECT COUNT(*) FROM {sheet_name}{where}", params).fetchone()[0]
+
+    def ids(self, sheet_name, filters=None):
+        """Ids of the rows matching filters"""
+        where, params = self._where(sheet_name, filters)
+        return [row[0] for row in self.connection().execute(f"SELECT id FROM {sheet_name}{where}", params)]
+
+    def query(self, sheet_name, filters=None, order_by='id', descending=False, offset=0, limit=50):
+        """One page of rows (dicts, including computed columns), filtered and sorted in SQLite"""
+        computed = self.COMPUTED.get(sheet_name, {})
+        select = ", ".join([c for c in SHEET_HEADERS[sheet_name] if c not in computed] +
+                           [f"{sql} AS {name}" for name, sql in computed.items()])
+        if order_by not in computed:
+            order_by = _check_column(sheet_name, order_by)
+        where, params = self._where(sheet_name, filters)
+        rows = self.connection().execute(
+            f"SELECT {select} FROM {sheet_name}{where} "
+            f"ORDER BY {order_by} {'DESC' if descending else 'ASC'}, id LIMIT ? OFFSET ?",
+            params + [int(limit), int(offset)]
+        )
+        return [dict(row) for row in rows]
+
+    def insert_missing(self, sheet_name, records):
+        """INSERT OR IGNORE records by id; returns the ones that were new locally"""
+        headers = SHEET_HEADERS[sheet_name]
+        inserted = []
+        bumped = {}
+        with self.connection() as conn:
+            for record in records:
+                cursor = conn.execute(
+                    f"INSERT OR IGNORE INTO {sheet_name} ({', '.join(headers)}) "
+                    f"VALUES ({', '.join('?' * len(headers))})",
+                    [record.get(h, '') for h in headers]
+                )
+                if cursor.rowcount > 0:
+                    inserted.append(record)
+            if inserted:
+                bumped = self._bump(conn, [sheet_name])
+        self._committed(bumped)
+        return inserted
+
+    def reserve_ids(self, sheet_name, count=1):
+        """Persisted high-water mark per table; BEGIN IMMEDIATE serialises concurrent sessions"""
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT next_id FROM id_sequence WHERE name = ?", (sheet_name,)).fetchone()
+            # MAX on the primary key is an index lookup; it covers rows that arrived from the mirror
+            max_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {sheet_name}").fetchone()[0]
+            start = max(row[0] if row else 1, max_id + 1)
+            conn.execute(
+                "INSERT INTO id_sequence (name, next_id) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET next_id = excluded.next_id",
+                (sheet_name, start + count)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return range(start, start + count)
+
+
+def _is_rate_limited(error):
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None) == 429 or getattr(error, 'code', None) == 429
+
+
+def _a1(row, col):
+    """A1 label of a cell (gspread is imported on first use)"""
+    from gspread.utils import rowcol_to_a1
+    return rowcol_to_a1(row, col)
+
+
+class SheetsClient:
+    """Quota-aware gate for Google Sheets API requests.
+
+    Identical concurrent reads share one in-flight request (single-flight), every
+    request takes a token from a bucket refilled at the per-minute quota, and 429
+    responses are retried with exponential backoff and jitter before giving up.
+    """
+    READS = {'get', 'col_values', 'get_all_records', 'values_batch_get', 'acell'}
+    MAX_RETRIES = 5
+    MAX_RETRY_WAIT = 32  # Seconds
+
+    def __init__(self, per_minute=60, burst=10):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._bucket_lock = threading.Lock()
+        self._flights_lock = threading.Lock()
+        self._flights = {}  # request key -> {'done': Event, 'result', 'error'}
+        self.calls = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.throttled_seconds = 0.0
+        self.backoff_seconds = 0.0
+
+    def _take_token(self):
+        """Block until the bucket has a token for one request"""
+        while True:
+            with self._bucket_lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+                self._refilled = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+                self.throttled_seconds += wait
+            time.sleep(wait)
+
+    def _send(self, target, method, args, kwargs):
+        for attempt in range(self.MAX_RETRIES + 1):
+            self._take_token()
+            self.calls += 1
+            try:
+                return getattr(target, method)(*args, **kwargs)
+            except Exception as e:
+                if not _is_rate_limited(e) or attempt == self.MAX_RETRIES:
+                    raise
+                self.rate_limited += 1
+                self.retries += 1
+                wait = min(2 ** attempt, self.MAX_RETRY_WAIT) * random.uniform(0.5, 1.5)
+                self.backoff_seconds += wait
+                time.sleep(wait)
+
+    def request(self, target, method, *args, **kwargs):
+        """Call target.method(*args, **kwargs) through the bucket; reads are single-flight"""
+        if method not in self.READS:
+            return self._send(target, method, args, kwargs)
+        key = (id(target), method, repr(args), repr(sorted(kwargs.items())))
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = {'done': threading.Event(), 'result': None, 'error': None}
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight['done'].wait()
+            if flight['error'] is not None:
+                raise flight['error']
+            return flight['result']
+        try:
+            flight['result'] = self._send(target, method, args, kwargs)
+            return flight['result']
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+            flight['done'].set()
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'calls_saved': self.coalesced,
+            'retries': self.retries,
+            'rate_limited': self.rate_limited,
+            'throttled_seconds': round(self.throttled_seconds, 3),
+            'backoff_seconds': round(self.backoff_seconds, 3),
+            'tokens': round(self._tokens, 2),
+        }
+
+
+class GoogleSheetsBackend(StorageBackend):
+    """Google Sheets mirror; `connect` returns the worksheet dict from init_google_sheets.
+
+    Only used behind MirroredBackend: the outbox sends it resolved values, so it
+    has no increments, and SQLite serves reads and allocates ids. Keeps an
+    id -> row-number index per worksheet (built once from column A, maintained
+    on append/delete) so writes never re-download a sheet, and sends every
+    value write of a batch in a single values.batchUpdate call.
+    """
+    name = "sheets"
+
+    def __init__(self, connect, client=None):
+        self._connect = connect
+        self.client = client or SheetsClient()
+        self._lock = threading.RLock()
+        self._row_index = {}  # sheet -> {id: row number}
+        self._last_row = {}   # sheet -> last used row number (1 = header only)
+        self._seen = {}       # sheet -> ids known to be in the sheet (survives index rebuilds)
+
+    def worksheet(self, sheet_name):
+        return self._connect()[sheet_name]
+
+    def _remote(self, call, method, *args, **kwargs):
+        """One Sheets API request through the quota-aware client, traced as sheets.<method>"""
+        with tracer.span(f"sheets.{method}", remote=True):
+            return self.client.request(call, method, *args, **kwargs)
+
+    def reset_index(self, sheet_name=None):
+        """Forget row numbers (after the sheet was edited outside the app)"""
+        with self._lock:
+            for name in [sheet_name] if sheet_name else list(self._row_index):
+                self._row_index.pop(name, None)
+                self._last_row.pop(name, None)
+
+    def _build_index(self, sheet_name, ids):
+        self._row_index[sheet_name] = {
+            int(value): row for row, value in enumerate(ids[1:], start=2)
+            if str(value).strip().isdigit()
+        }
+        self._last_row[sheet_name] = max(len(ids), 1)
+        self._seen.setdefault(sheet_name, set(self._row_index[sheet_name]))
+
+    def _ensure_index(self, sheet_names):
+        """Build the missing row indexes from one batched read of their id columns"""
+        with self._lock:
+            missing = [name for name in sheet_names if name not in self._row_index]
+            for sheet_name, ids in zip(missing, self._batch_get([f"'{name}'!A:A" for name in missing])):
+                self._build_index(sheet_name, [row[0] if row else '' for row in ids])
+
+    def row_index(self, sheet_name):
+        """id -> row number, built from a single column read"""
+        with self._lock:
+            if sheet_name not in self._row_index:
+                self._build_index(sheet_name, self._remote(self.worksheet(sheet_name), 'col_values', 1))
+            return self._row_index[sheet_name]
+
+    def _end_col(self, sheet_name):
+        return _a1(1, len(SHEET_HEADERS[sheet_name]))[:-1]
+
+    def _batch_get(self, ranges):
+        """Values for several A1 ranges in a single values.batchGet request"""
+        if not ranges:
+            return []
+        response = self._remote(
+            self.worksheet(SHEET_NAMES[0]).spreadsheet, 'values_batch_get', ranges,
+            params={'valueRenderOption': 'UNFORMATTED_VALUE'}
+        )
+        return [value_range.get('values', []) for value_range in response.get('valueRanges', [])]
+
+    def fetch_many(self, sheet_names):
+        """Every row of several sheets from one request (records keyed by each sheet's header row)"""
+        from gspread.utils import numericise_all
+        sheet_names = list(sheet_names)
+        with self._lock:
+            tables = self._batch_get([f"'{name}'!A:{self._end_col(name)}" for name in sheet_names])
+            for sheet_name, values in zip(sheet_names, tables):
+                # Later tail pulls start right after the rows just read
+                self._build_index(sheet_name, [row[0] if row else '' for row in values])
+        result = {}
+        for sheet_name, values in zip(sheet_names, tables):
+            headers = [str(h) for h in values[0]] if values else SHEET_HEADERS[sheet_name]
+            # Numeric strings become numbers, as get_all_records() would return them
+            result[sheet_name] = [
+                dict(zip(headers, numericise_all(
+                    list(row) + [''] * (len(headers) - len(row)), default_blank='')))
+                for row in values[1:] if any(str(cell).strip() for cell in row)
+            ]
+        return result
+
+    def pull_tails(self, sheet_names):
+        """{sheet: records appended past its last known row}, all sheets in one request"""
+        with self._lock:
+            sheet_names = list(sheet_names)
+            self._ensure_index(sheet_names)
+            firsts = {name: self._last_row[name] + 1 for name in sheet_names}
+            tables = self._batch_get([f"'{name}'!A{firsts[name]}:{self._end_col(name)}" for name in sheet_names])
+            return {name: self._take_tail(name, firsts[name], values)
+                    for name, values in zip(sheet_names, tables)}
+
+    def _take_tail(self, sheet_name, first, values):
+        """Index rows read from `first` onwards and return them as records"""
+        with self._lock:
+            headers = SHEET_HEADERS[sheet_name]
+            records = []
+            for offset, row in enumerate(values):
+                record = dict(zip(headers, list(row) + [''] * (len(headers) - len(row))))
+                row_id = _to_int(record['id'])
+                if row_id is None:
+                    continue
+                record['id'] = row_id
+                self._row_index[sheet_name][row_id] = first + offset
+                self._seen[sheet_name].add(row_id)
+                records.append(record)
+            self._last_row[sheet_name] = max(self._last_row[sheet_name], first + len(values) - 1)
+            return records
+
+    def pull_id_changes_many(self, last_checksums):
+        """{sheet: (checksum, removed_ids, added_ids)} from one read of every id column"""
+        with self._lock:
+            sheet_names = list(last_checksums)
+            columns = self._batch_get([f"'{name}'!A:A" for name in sheet_names])
+            return {name: self.pull_id_changes(name, last_checksums[name], [row[0] if row else '' for row in ids])
+                    for name, ids in zip(sheet_names, columns)}
+
+    def pull_id_changes(self, sheet_name, last_checksum=None, ids=None):
+        """Re-read the id column (unless given) and diff it against the index.
+
+        Returns (checksum, removed_ids, added_ids). The diff is against the ids seen
+        in the sheet before, not the index: rows not yet mirrored are never reported
+        as removed, and rows added by hand are reported even after an index rebuild.
+        """
+        with self._lock:
+            self.row_index(sheet_name)
+            known = set(self._seen[sheet_name])
+            if ids is None:
+                ids = self._remote(self.worksheet(sheet_name), 'col_values', 1)
+            checksum = zlib.crc32("\n".join(map(str, ids)).encode())
+            if checksum == last_checksum:
+                return checksum, set(), set()
+            self._build_index(sheet_name, ids)
+            current = set(self._row_index[sheet_name])
+            self._seen[sheet_name] = current
+            return checksum, known - current, current - known
+
+    def _cell(self, sheet_name, row, column):
+        col = SHEET_HEADERS[sheet_name].index(_check_column(sheet_name, column)) + 1
+        return f"'{sheet_name}'!{_a1(row, col)}"
+
+    def write_batch(self, appends=(), updates=()):
+        """Append rows and update cells without trusting row numbers blindly.
+
+        New ids go through values.append (INSERT_ROWS), so they never overwrite a row
+        added by hand; their row numbers come from the response. Rows of known ids are
+        rewritten in place (replays are idempotent) and cells updated only once column A
+        of the target row was checked to still hold the id; a row deleted by hand is
+        appended again. Updates of ids the sheet does not have raise LookupError once
+        the rest was written, so the outbox keeps them queued.
+        """
+        with self._lock:
+            appends = [(sheet_name, list(row)) for sheet_name, row in appends]
+            updates = list(updates)
+            self._ensure_index({op[0] for op in appends} | {op[0] for op in updates})
+            placed = self._append_rows([(sheet_name, row) for sheet_name, row in appends
+                                        if _to_int(row[0]) not in self._row_index[sheet_name]])
+            rewrites = [(sheet_name, row) for sheet_name, row in appends if (sheet_name, _to_int(row[0])) not in placed]
+            targets = {(sheet_name, _to_int(row[0])) for sheet_name, row in rewrites}
+            targets |= {(sheet_name, row_id) for sheet_name, row_id, _, _ in updates} - set(placed)
+            rows = self._verified_rows(targets)
+            lost = [(sheet_name, row) for sheet_name, row in rewrites if (sheet_name, _to_int(row[0])) not in rows]
+            if lost:
+                placed.update(self._append_rows(lost))
+                rows = self._verified_rows(targets - set(placed))  # An insert may have moved rows
+            rows.update(placed)
+
+            data = []
+            for sheet_name, row in rewrites:
+                row_number = rows.get((sheet_name, _to_int(row[0])))
+                if row_number and (sheet_name, _to_int(row[0])) not in placed:
+                    end_col = _a1(row_number, len(row))
+                    data.append({'range': f"'{sheet_name}'!A{row_number}:{end_col}", 'values': [row]})
+            missing = []
+            for sheet_name, row_id, column, value in updates:
+                row_number = rows.get((sheet_name, row_id))
+                if row_number:
+                    data.append({'range': self._cell(sheet_name, row_number, column), 'values': [[value]]})
+                else:
+                    missing.append(f"{sheet_name} #{row_id}")
+            if data:
+                spreadsheet = self.worksheet(SHEET_NAMES[0]).spreadsheet
+                self._remote(spreadsheet, 'values_batch_update', {'valueInputOption': 'RAW', 'data': data})
+            if missing:
+                raise LookupError(f"No row to update for {', '.join(sorted(set(missing)))}")
+
+    def _append_rows(self, appends):
+        """values.append each sheet's rows after its data; returns {(sheet, id): row number}"""
+        placed = {}
+        for sheet_name, group in groupby(appends, key=lambda op: op[0]):
+            rows = [row for _, row in group]
+            response = self._remote(
+                self.worksheet(sheet_name).spreadsheet, 'values_append', f"'{sheet_name}'!A1",
+                params={'valueInputOption': 'RAW', 'insertDataOption': 'INSERT_ROWS'}, body={'values': rows}
+            )
+            first = int(re.search(r"!\$?[A-Z]+\$?(\d+)", response['updates']['updatedRange']).group(1))
+            if first <= self._last_row[sheet_name]:
+                # Rows were removed by hand (or a gap moved the insert): re-read the positions
+                self.reset_index(sheet_name)
+                self._ensure_index([sheet_name])
+            else:
+                if first == self._last_row[sheet_name] + 1:
+                    self._last_row[sheet_name] = first + len(rows) - 1
+                # else rows added by hand sit in between; the next tail pull reads them
+                for offset, row in enumerate(rows):
+                    self._row_index[sheet_name][int(row[0])] = first + offset
+            for row in rows:
+                placed[(sheet_name, int(row[0]))] = self._row_index[sheet_name].get(int(row[0]))
+                self._seen[sheet_name].add(int(row[0]))
+        return placed
+
+    def _verified_rows(self, targets):
+        """{(sheet, id): row number} for ids whose row still holds them in column A.
+
+        A mismatch means the sheet was edited by hand: the index is rebuilt once and
+        the ids are looked up again. Ids still not found are left out.
+        """
+        rows = {}
+        for attempt in range(2):
+            todo = [(sheet_name, row_id, self.row_index(sheet_name).get(row_id))
+                    for sheet_name, row_id in targets if (sheet_name, row_id) not in rows]
+            check = [(sheet_name, row_id, row) for sheet_name, row_id, row in todo if row]
+            stale = {sheet_name for sheet_name, _, row in todo if not row}
+            cells = self._batch_get([f"'{sheet_name}'!A{row}" for sheet_name, _, row in check])
+            for (sheet_name, row_id, row), values in zip(check, cells):
+                if values and values[0] and _to_int(values[0][0]) == row_id:
+                    rows[(sheet_name, row_id)] = row
+                else:
+                    stale.add(sheet_name)
+            if not stale or attempt:
+                return rows
+            for sheet_name in stale:
+                self.reset_index(sheet_name)
+        return rows
+
+    def delete_row(self, sheet_name, row_id):
+        with self._lock:
+            worksheet = self.worksheet(sheet_name)
+            row = self.row_index(sheet_name).get(row_id)
+            if row and str(self._remote(worksheet, 'acell', f"A{row}").value) != str(row_id):
+                self.reset_index(sheet_name)  # Sheet changed underneath us
+                row = self.row_index(sheet_name).get(row_id)
+            if not row:
+                return False
+            self._remote(worksheet, 'delete_rows', row)
+            index = self._row_index[sheet_name]
+            del index[row_id]
+            self._seen[sheet_name].discard(row_id)
+            for key, value in index.items():
+                if value > row:
+                    index[key] = value - 1
+            self._last_row[sheet_name] -= 1
+            return True
+
+
+class MirroredBackend(StorageBackend):
+    """SQLite primary with a Google Sheets mirror fed through the primary's outbox.
+
+    Every write commits locally together with its outbox entry and returns at
+    once; an OutboxFlusher applies the queue to the mirror in the background.
+    """
+
+    def __init__(self, primary, mirror):
+        self.primary = primary
+        self.mirror = mirror
+        self.name = f"{primary.name}+{mirror.name}"
+        self.on_write = None  # Set to the flusher's wake-up once it is running
+
+    def seed_from_mirror(self):
+        """Copy mirror rows into any empty primary table (first start on an existing sheet)"""
+        empty = [name for name, rows in self.primary.fetch_many(SHEET_NAMES).items() if not rows]
+        for sheet_name, records in (self.mirror.fetch_many(empty) if empty else {}).items():
+            headers = SHEET_HEADERS[sheet_name]
+            records = [r for r in records if r.get('id') not in ('', None)]
+            if records:
+                self.primary.append_rows(sheet_name, [[r.get(h, '') for h in headers] for r in records])
+
+    def _queued(self):
+        if self.on_write:
+            self.on_write()
+
+    def fetch_all(self, sheet_name):
+        return self.primary.fetch_all(sheet_name)
+
+    def fetch_many(self, sheet_names):
+        return self.primary.fetch_many(sheet_names)
+
+    def write_batch(self, appends=(), updates=(), increments=()):
+        results = self.primary.write_batch(appends, updates, increments, journal=True)
+        self._queued()
+        return results
+
+    def delete_row(self, sheet_name, row_id, increments=()):
+        deleted = self.primary.delete_row(sheet_name, row_id, increments, journal=True)
+        if deleted:
+            self._queued()
+        return deleted
+
+    def reserve_ids(self, sheet_name, count=1):
+        return self.primary.reserve_ids(sheet_name, count)
+
+
+@st.cache_resource
+def init_storage():
+    """Create the storage backend: local SQLite, mirrored to Google Sheets when configured"""
+    try:
+        backend = SQLiteBackend(get_setting("sqlite_path", "coaching_erp.db"))
+    except Exception as e:
+        st.error(f"Error opening local database: {e}")
+        return None
+    
+    mirror_setting = str(get_setting("sheets_mirror", "auto")).lower()
+    if mirror_setting in ("off", "false", "0") or get_setting("gcp_service_account") is None:
+        return backend  # Fully offline
+    
+    if init_google_sheets() is None:
+        return backend
+    client = SheetsClient(per_minute=float(get_setting("sheets_quota_per_minute", 60)))
+    mirrored = MirroredBackend(backend, GoogleSheetsBackend(init_google_sheets, client))
+    try:
+        mirrored.seed_from_mirror()
+    except Exception as e:
+        st.warning(f"Could not import existing data from Google Sheets: {e}")
+    return mirrored
+
+backend = None  # Opened by start_services() once a user has logged in
+
+# ================= CLUSTER COORDINATION =================
+
+CLUSTER_POLL = 2    # Seconds between checks of the shared table versions
+LEADER_LEASE = 15   # Seconds a leader stays elected without renewing
+
+class ClusterChannel:
+    """Keeps app processes that share one SQLite database coherent.
+
+    Each process polls the table_versions counters; a table moved by another
+    process's write is invalidated locally (this process's own writes already
+    patched its cache). Google Sheets work (sync pulls, the outbox) runs only in
+    the process holding the leader lease, so each change is fetched once for the
+    whole cluster and the others pick it up through the counters. A process that
+    becomes leader calls on_elected first: its picture of the sheets is stale.
+    """
+
+    def __init__(self, local, on_change, poll=CLUSTER_POLL, on_elected=lambda: None):
+        self.local = local
+        self.on_change = on_change  # Called with the tables other processes changed
+        self.on_elected = on_elected
+        self.poll = poll
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.leader = False
+        self.invalidations = 0
+        self.last_error = None
+        local.track_writes = True
+        self.seen = local.table_versions()
+        self._elect()
+        self._thread = threading.Thread(target=self._run, name="cluster-channel", daemon=True)
+        self._thread.start()
+
+    def _elect(self):
+        was_leader = self.leader
+        try:
+            self.leader = self.local.acquire_lease("leader", self.owner, LEADER_LEASE)
+        except Exception:
+            self.leader = False  # Another process may take over once the lease expires
+            raise
+        if self.leader and not was_leader:
+            self.on_elected()
+
+    def check(self):
+        """Renew the lease and invalidate tables other processes changed; returns those tables"""
+        self._elect()
+        self.seen, changed = self.local.foreign_changes(self.seen)
+        if changed:
+            self.invalidations += len(changed)
+            self.on_change(sorted(changed))
+        return changed
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll)
+            try:
+                self.check()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+
+    def stats(self):
+        return {'owner': self.owner, 'leader': self.leader, 'invalidations': self.invalidations,
+                'versions': dict(self.seen), 'last_error': self.last_error}
+
+def cluster_changed(sheet_names):
+    """Another process wrote these tables: drop our cached copies and let the outbox run"""
+    invalidate_cache(*sheet_names)
+    if outbox_flusher is not None:
+        outbox_flusher.wake()
+
+def cluster_elected():
+    """Leadership gained: the previous leader moved sheet rows this process never saw"""
+    mirror = getattr(backend, 'mirror', None)
+    if mirror is not None:
+        mirror.reset_index()
+
+@st.cache_resource
+def init_cluster():
+    """Cross-process invalidation channel, or None when disabled (setting cluster_poll = off)"""
+    poll = str(get_setting("cluster_poll", CLUSTER_POLL)).lower()
+    if backend is None or poll in ("off", "false", "0"):
+        return None
+    return ClusterChannel(getattr(backend, 'primary', backend), cluster_changed, float(poll), cluster_elected)
+
+cluster = None  # Set by start_services()
+
+def is_leader():
+    """True unless another process holds the leader lease"""
+    return cluster is None or cluster.leader
+
+# ================= INCREMENTAL SYNC FROM GOOGLE SHEETS =================
+
+SYNC_INTERVAL = CACHE_DURATION  # Seconds between tail pulls of a sheet
+CHECKSUM_INTERVAL = 300         # Seconds between id-column checksums (detects deletes)
+
+class SheetsSync:
+    """Pulls rows added or deleted directly in Google Sheets into the local store.
+
+    Each pull reads only the rows past the last known one, so its cost follows
+    new rows rather than sheet size. Deletes and mid-sheet inserts are found by a
+    periodic checksum of the id column. In-place edits of existing rows are not pulled.
+    Sheets that are due together share one batched request per step.
+    """
+
+    def __init__(self, local, remote):
+        self.local = local
+        self.remote = remote
+        self._lock = threading.Lock()
+        self.state = {}
+
+    def sheet_state(self, sheet_name):
+        return self.state.setdefault(sheet_name, {
+            'last_sync': 0, 'last_checksum': 0, 'checksum': None, 'high_water': 0, 'rows_pulled': 0
+        })
+
+    def sync_many(self, requests):
+        """Pull every due sheet of {sheet_name: force}; returns {sheet_name: (new_records, removed_ids)}"""
+        now = time.time()
+        with self._lock:
+            states = {sheet_name: self.sheet_state(sheet_name) for sheet_name in requests}
+            due = [name for name, force in requests.items()
+                   if force or now - states[name]['last_sync'] >= SYNC_INTERVAL]
+            if not due:
+                return {}
+            for sheet_name in due:
+                states[sheet_name]['last_sync'] = now
+            deleting = {sheet_name: self.local.outbox_deleted_ids(sheet_name) for sheet_name in due}
+            results = {}
+            for sheet_name, records in self.remote.pull_tails(due).items():
+                records = [r for r in records if r['id'] not in deleting[sheet_name]]
+                results[sheet_name] = (self.local.insert_missing(sheet_name, records), set())
+            
+            checks = {name: states[name]['checksum'] for name in due
+                      if requests[name] or now - states[name]['last_checksum'] >= CHECKSUM_INTERVAL}
+            changes = self.remote.pull_id_changes_many(checks) if checks else {}
+            added = {}
+            for sheet_name, (checksum, removed, new_ids) in changes.items():
+                states[sheet_name]['last_checksum'] = now
+                states[sheet_name]['checksum'] = checksum
+                if new_ids - deleting[sheet_name]:
+                    added[sheet_name] = new_ids - deleting[sheet_name]
+                for row_id in removed:
+                    self.local.delete_row(sheet_name, row_id)
+                results[sheet_name][1].update(removed)
+            for sheet_name, records in (self.remote.fetch_many(added) if added else {}).items():
+                records = [r for r in records if _to_int(r.get('id')) in added[sheet_name]]
+                results[sheet_name][0].extend(self.local.insert_missing(sheet_name, records))
+            
+            for sheet_name, (new_records, _) in results.items():
+                state = states[sheet_name]
+                state['high_water'] = max([state['high_water']] + [r['id'] for r in new_records])
+                state['rows_pulled'] += len(new_records)
+            return results
+
+@st.cache_resource
+def init_sync_engine():
+    """Sync engine for the Google Sheets mirror, or None when running offline"""
+    if getattr(backend, 'mirror', None) is None:
+        return None
+    return SheetsSync(backend.primary, backend.mirror)
+
+sync_engine = None  # Set by start_services()
+
+# ================= BACKGROUND REFRESH =================
+
+REFRESH_AHEAD = 0.8   # Refresh entries once they reach this fraction of CACHE_DURATION
+REFRESH_POLL = 2      # Seconds between worker checks
+MAX_BACKOFF = 300     # Seconds
+
+class RefreshWorker:
+    """Daemon thread that renews shared cache entries ahead of expiry.
+
+    Readers always get the last good snapshot immediately; network work only
+    happens here. Failures back off exponentially with jitter (longer on 429s).
+    """
+
+    def __init__(self, refresh):
+        self._refresh = refresh  # Called with {sheet_name: force}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._requests = {}  # sheet -> force
+        self.failures = 0
+        self.backoff_until = 0
+        self.last_error = None
+        self.refreshes = 0
+        self._thread = threading.Thread(target=self._run, name="sheet-refresh", daemon=True)
+        self._thread.start()
+
+    def request(self, *sheet_names, force=False):
+        """Ask for a refresh without waiting for it"""
+        with self._lock:
+            for sheet_name in sheet_names:
+                self._requests[sheet_name] = self._requests.get(sheet_name, False) or force
+        self._wake.set()
+
+    def _due(self):
+        due = {}
+        for sheet_name in SHEET_NAMES:
+            age = shared_cache.age(f"data_{sheet_name}")
+            if age is not None and age >= shared_cache.ttl * REFRESH_AHEAD:
+                due[sheet_name] = False
+        with self._lock:
+            for sheet_name, force in self._requests.items():
+                due[sheet_name] = due.get(sheet_name, False) or force
+            self._requests = {}
+        return due
+
+    def _run(self):
+        while True:
+            self._wake.wait(REFRESH_POLL)
+            self._wake.clear()
+            if time.time() < self.backoff_until:
+                continue
+            pending = self._due()
+            if not pending:
+                continue
+            try:
+                self._refresh(pending)  # All due sheets in one batched pass
+                self.refreshes += len(pending)
+                self.failures = 0
+            except Exception as e:
+                self.failures += 1
+                self.last_error = f"{', '.join(pending)}: {e}"
+                base = 2 ** min(self.failures, 8) * (4 if _is_rate_limited(e) else 1)
+                self.backoff_until = time.time() + min(base, MAX_BACKOFF) * random.uniform(0.5, 1.5)
+                self.request(*pending)
+
+    def stats(self):
+        return {
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+            'backing_off_for': max(0.0, self.backoff_until - time.time()),
+            'last_error': self.last_error,
+        }
+
+@st.cache_resource
+def init_refresh_worker():
+    """One refresh thread per server process"""
+    return RefreshWorker(refresh_sheets)
+
+
+# ================= MIRROR OUTBOX =================
+
+FLUSH_BATCH = 100          # Outbox operations sent to Google Sheets per round
+FLUSH_POLL = 5             # Seconds between outbox checks when idle
+OUTBOX_MAX_ATTEMPTS = 20   # Operations failing this often are parked for manual review
+
+class OutboxFlusher:
+    """Daemon thread that applies the local outbox to the Google Sheets mirror.
+
+    Consecutive writes are merged into one batched request; deletes go one at a
+    time, followed by the updates journaled with them. Entries are removed only after the mirror accepted them, and replays are
+    harmless because entries carry resolved values (appends rewrite rows whose id
+    already exists, updates set absolute values, deletes of missing rows are
+    no-ops). An update whose row the mirror lacks fails only its own entry, which
+    is retried and eventually parked. Failures back off exponentially with jitter.
+    """
+
+    def __init__(self, local, mirror, leader=lambda: True):
+        self.local = local
+        self.mirror = mirror
+        self.leader = leader  # Only one process in a cluster drains the shared outbox
+        self._wake = threading.Event()
+        self.failures = 0
+        self.backoff_until = 0
+        self.last_error = None
+        self.flushed = 0
+        self._thread = threading.Thread(target=self._run, name="outbox-flush", daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def _groups(self, entries):
+        """Split entries into runs of writes (merged) and single deletes"""
+        group = []
+        for entry in entries:
+            if 'delete' in entry[1]:
+                if group:
+                    yield group
+                    group = []
+                yield [entry]
+            else:
+                group.append(entry)
+        if group:
+            yield group
+
+    def _apply(self, group):
+        if 'delete' in group[0][1]:
+            op = group[0][1]
+            self.mirror.delete_row(*op['delete'])
+            if op.get('updates'):
+                self.mirror.write_batch((), [tuple(update) for update in op['updates']])
+            return
+        appends = [(sheet_name, row) for _, op in group for sheet_name, row in op['appends']]
+        updates = [tuple(update) for _, op in group for update in op['updates']]
+        self.mirror.write_batch(appends, updates)
+
+    def flush(self):
+        """Apply queued operations until the outbox is empty or a round fails"""
+        while True:
+            entries = self.local.outbox_pending(FLUSH_BATCH, OUTBOX_MAX_ATTEMPTS)
+            if not entries:
+                return
+            for group in self._groups(entries):
+                try:
+                    self._apply(group)
+                except LookupError as e:
+                    if len(group) == 1:
+                        self._failed(group, e)
+                        raise
+                    # One merged entry names a row the mirror lacks: apply them one by
+                    # one so only that entry stays queued
+                    error = None
+                    for entry in group:
+                        try:
+                            self._apply([entry])
+                        except LookupError as e:
+                            self.local.outbox_fail([entry[0]], e)
+                            error = e
+                        else:
+                            self._done([entry])
+                    if error:
+                        raise error
+                    continue
+                except Exception as e:
+                    self._failed(group, e)
+                    raise
+                self._done(group)
+
+    def _done(self, group):
+        self.local.outbox_ack([seq for seq, _ in group])
+        self.flushed += len(group)
+
+    def _failed(self, group, error):
+        self.local.outbox_fail([seq for seq, _ in group], error)
+        self.mirror.reset_index()  # A half-applied write may have moved rows
+
+    def _run(self):
+        while True:
+            self._wake.wait(FLUSH_POLL)
+            self._wake.clear()
+            if time.time() < self.backoff_until or not self.leader():
+                continue
+            try:
+                self.flush()
+                self.failures = 0
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                base = 2 ** min(self.failures, 8) * (4 if _is_rate_limited(e) else 1)
+                self.backoff_until = time.time() + min(base, MAX_BACKOFF) * random.uniform(0.5, 1.5)
+
+    def stats(self):
+        return dict(self.local.outbox_stats(OUTBOX_MAX_ATTEMPTS), flushed=self.flushed,
+                    failures=self.failures, last_error=self.last_error,
+                    backing_off_for=max(0.0, self.backoff_until - time.time()))
+
+@st.cache_resource
+def init_outbox_flusher():
+    """One outbox thread per server process, or None when running offline"""
+    if getattr(backend, 'mirror', None) is None:
+        return None
+    flusher = OutboxFlusher(backend.primary, backend.mirror, is_leader)
+    backend.on_write = flusher.wake
+    flusher.wake()  # Drain anything queued before a restart
+    return flusher
+
+outbox_flusher = None  # Set by start_services()
 
 # ================= DATABASE OPERATIONS WITH CACHING =================
 
+def refresh_sheets(requests):
+    """Pull remote changes for {sheet_name: force} into the local store and shared cache.
+
+    All due sheets share one batched Sheets request per sync step. In a cluster only
+    the leader pulls unless forced; the others see its inserts via ClusterChannel.
+    """
+    pull = sync_engine is not None and (is_leader() or any(requests.values()))
+    changes = sync_engine.sync_many(requests) if pull else {}
+    for sheet_name in requests:
+        new_records, removed = changes.get(sheet_name, ([], set()))
+        if removed:
+            invalidate_cache(sheet_name)
+            continue
+        if new_records:
+            cache_append_records(sheet_name, sorted(new_records, key=lambda r: r['id']))
+        shared_cache.touch(f"data_{sheet_name}")  # The local store is otherwise kept current by the write paths
+    if snapshot_store is not None and is_leader():  # The snapshot directory is shared too
+        for sheet_name in requests:
+            snapshot_store.save(sheet_name)
+
+def prefetch(*sheet_names):
+    """Load every uncached sheet from one consistent read and publish them together.
+
+    Sheets whose frame comes from a snapshot are left out: their rows are not needed.
+    """
+    missing = [name for name in sheet_names or SHEET_NAMES
+               if shared_cache.age(f"data_{name}") is None and not _snapshot_served(name)]
+    if len(missing) < 2 or not backend:
+        return
+    versions = {name: shared_cache.version(f"data_{name}") for name in missing}
+    with tracer.span("prefetch"):
+        tables = backend.fetch_many(missing)
+    for sheet_name, data in tables.items():
+        set_cached_data(f"data_{sheet_name}", data, versions[sheet_name])
+
+refresh_worker = None  # Set by start_services()
+
+@traced()
 def get_all_data(sheet_name):
     """Get all data with caching"""
     cache_key = f"data_{sheet_name}"
@@ -159,157 +1684,768 @@ def get_all_data(sheet_name):
     if cached is not None:
         return cached
     
-    # Fetch from Google Sheets
+    refresh_worker.request(sheet_name)  # Remote changes are pulled in the background
     try:
-        sheet = sheets[sheet_name]
-        data = sheet.get_all_records()
-        set_cached_data(cache_key, data)
+        version = shared_cache.version(cache_key)
+        data = backend.fetch_all(sheet_name)
+        set_cached_data(cache_key, data, version)
         return data
     except Exception as e:
         st.error(f"Error fetching {sheet_name}: {e}")
         return []
 
-def get_students_df():
-    """Get students as DataFrame with caching"""
-    data = get_all_data('students')
-    if not data:
-        return pd.DataFrame(columns=['id', 'name', 'phone', 'course', 'fee', 'paid', 'status', 'date'])
-    df = pd.DataFrame(data)
-    df['id'] = pd.to_numeric(df['id'], errors='coerce')
-    df['fee'] = pd.to_numeric(df['fee'], errors='coerce')
-    df['paid'] = pd.to_numeric(df['paid'], errors='coerce')
+# Explicit column types for the shared DataFrames
+FRAME_SCHEMA = {
+    'students': {'id': 'Int32', 'name': 'text', 'phone': 'text', 'course': 'category',
+                 'fee': 'float64', 'paid': 'float64', 'status': 'category', 'date': 'datetime'},
+    'payments': {'id': 'Int32', 'student_id': 'Int32', 'amount': 'float64',
+                 'mode': 'category', 'date': 'datetime'},
+    'expenses': {'id': 'Int32', 'title': 'text', 'amount': 'float64',
+                 'category': 'category', 'date': 'datetime'},
+    'investments': {'id': 'Int32', 'investor': 'category', 'amount': 'float64',
+                    'date': 'datetime', 'notes': 'text'},
+}
+
+def _typed_frame(sheet_name, data):
+    """Build a DataFrame for a sheet and coerce it to FRAME_SCHEMA"""
+    df = pd.DataFrame(data, columns=SHEET_HEADERS[sheet_name])
+    for column, kind in FRAME_SCHEMA[sheet_name].items():
+        if kind == 'Int32':
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype('Int32')
+        elif kind == 'float64':
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype('float64')
+        elif kind == 'category':
+            df[column] = df[column].astype('category')
+        elif kind == 'datetime':
+            df[column] = pd.to_datetime(df[column], errors='coerce')
+        else:
+            df[column] = df[column].fillna('').astype(str)
     return df
 
+@traced()
+def get_sheet_df(sheet_name):
+    """Typed DataFrame for a sheet, parsed once per data version and shared by every
+    page and session. Treat it as read-only: copy() before modifying."""
+    return memoize((sheet_name,), 'frame', lambda: _load_frame(sheet_name))
+
+def _load_frame(sheet_name):
+    """On a cold cache try the on-disk snapshot first, else parse the cached/local rows"""
+    frame = _snapshot_frame(sheet_name)
+    return frame if frame is not None else _typed_frame(sheet_name, get_all_data(sheet_name))
+
+def _snapshot_frame(sheet_name):
+    """A cold sheet's frame from its snapshot (None when missing, stale or the cache is warm).
+
+    A hit queues a background sync, so changes newer than the snapshot are still pulled.
+    """
+    if snapshot_store is None or shared_cache.age(f"data_{sheet_name}") is not None:
+        return None
+    with tracer.span("snapshot.load"):
+        frame = snapshot_store.load(sheet_name)
+    if frame is not None and refresh_worker is not None:
+        refresh_worker.request(sheet_name)
+    return frame
+
+def _snapshot_served(sheet_name):
+    """True when the sheet's frame is memoised without its rows (from a snapshot)"""
+    return snapshot_store is not None and memoize(
+        (sheet_name,), 'frame', lambda: _snapshot_frame(sheet_name)) is not None
+
+@traced()
+def get_students_df():
+    """Students as a typed, memoised DataFrame; `paid` is derived from the payments ledger"""
+    def build():
+        df = get_sheet_df('students').copy()
+        df['paid'] = df['id'].map(student_paid_totals()).fillna(0.0).astype('float64')
+        return df
+    return memoize(('students', 'payments'), 'students_frame', build)
+
+def student_paid_totals():
+    """student_id -> total paid, from the incrementally maintained financial summary"""
+    return pd.Series(get_financial_summary().paid_by_student, dtype='float64')
+
+@traced()
 def get_payments_df():
-    """Get payments as DataFrame with caching"""
-    data = get_all_data('payments')
-    if not data:
-        return pd.DataFrame(columns=['id', 'student_id', 'amount', 'mode', 'date'])
-    df = pd.DataFrame(data)
-    df['id'] = pd.to_numeric(df['id'], errors='coerce')
-    df['student_id'] = pd.to_numeric(df['student_id'], errors='coerce')
-    df['amount'] = pd.to_numeric(df['amount'], errors='coerce')
-    return df
+    """Get payments as a typed, memoised DataFrame"""
+    return get_sheet_df('payments')
 
+@traced()
 def get_expenses_df():
-    """Get expenses as DataFrame with caching"""
-    data = get_all_data('expenses')
-    if not data:
-        return pd.DataFrame(columns=['id', 'title', 'amount', 'category', 'date'])
-    df = pd.DataFrame(data)
-    df['id'] = pd.to_numeric(df['id'], errors='coerce')
-    df['amount'] = pd.to_numeric(df['amount'], errors='coerce')
-    return df
+    """Get expenses as a typed, memoised DataFrame"""
+    return get_sheet_df('expenses')
 
+@traced()
 def get_investments_df():
-    """Get investments as DataFrame with caching"""
-    data = get_all_data('investments')
-    if not data:
-        return pd.DataFrame(columns=['id', 'investor', 'amount', 'date', 'notes'])
-    df = pd.DataFrame(data)
-    df['id'] = pd.to_numeric(df['id'], errors='coerce')
-    df['amount'] = pd.to_numeric(df['amount'], errors='coerce')
+    """Get investments as a typed, memoised DataFrame"""
+    return get_sheet_df('investments')
+
+def local_store():
+    """The SQLite store (the primary when mirrored to Google Sheets)"""
+    return getattr(backend, 'primary', backend)
+
+@traced()
+def count_rows(sheet_name, filters=None):
+    """Rows matching filters, counted in SQLite"""
+    return local_store().count(sheet_name, filters)
+
+@traced()
+def query_rows(sheet_name, filters=None, order_by='id', descending=False, offset=0, limit=50):
+    """One typed page of a sheet, filtered/sorted/paginated in SQLite"""
+    rows = local_store().query(sheet_name, filters, order_by, descending, offset, limit)
+    df = _typed_frame(sheet_name, rows)
+    if sheet_name == 'students':
+        df['pending'] = pd.to_numeric(pd.Series([r['pending'] for r in rows], dtype='object'),
+                                      errors='coerce').astype('float64')
     return df
 
 def get_next_id(sheet_name):
-    """Get next ID with caching"""
-    data = get_all_data(sheet_name)
-    if not data:
-        return 1
-    max_id = max([int(record['id']) for record in data if record.get('id')])
-    return max_id + 1
+    """Reserve the next ID (constant time, never handed out twice)"""
+    return backend.reserve_ids(sheet_name)[0]
 
+def reserve_id_block(sheet_name, count):
+    """Reserve `count` consecutive IDs for a bulk import"""
+    return backend.reserve_ids(sheet_name, count)
+
+@traced()
 def add_student(name, phone, course, fee):
-    """Add student and clear cache"""
+    """Add student and patch it into the cached students sheet"""
     try:
-        sheet = sheets['students']
         student_id = get_next_id('students')
         date = datetime.now().strftime("%Y-%m-%d")
-        sheet.append_row([student_id, name, phone, course, fee, 0, 'active', date])
-        clear_cache()  # Clear cache after modification
+        row = [student_id, name, phone, course, fee, 0, 'active', date]
+        backend.append_row('students', row)
+        cache_append_rows('students', [row])
         return student_id
     except Exception as e:
         st.error(f"Error adding student: {e}")
         return None
 
+@traced()
 def add_payment(student_id, amount, mode):
-    """Add payment and clear cache"""
+    """Add payment and patch it into the cached payments sheet (paid totals follow the ledger).
+
+    The stored students.paid column is kept as a write-through copy for people
+    reading the sheet; it is incremented in the same transaction and mirrored.
+    """
     try:
-        # Add to payments
-        sheet = sheets['payments']
+        # Before the write: a summary rebuilt after it would already include the row
+        student = get_student_by_id(student_id)
         payment_id = get_next_id('payments')
         date = datetime.now().strftime("%Y-%m-%d")
-        sheet.append_row([payment_id, student_id, amount, mode, date])
-        
-        # Update student paid amount
-        students_sheet = sheets['students']
-        all_records = students_sheet.get_all_records()
-        for idx, record in enumerate(all_records, start=2):
-            if int(record['id']) == student_id:
-                current_paid = float(record.get('paid', 0))
-                new_paid = current_paid + amount
-                students_sheet.update_cell(idx, 6, new_paid)
-                break
-        
-        clear_cache()  # Clear cache
+        row = [payment_id, student_id, amount, mode, date]
+        backend.write_batch(appends=[('payments', row)], increments=[('students', student_id, 'paid', amount)])
+        course = student['course'] if student else None
+        _patch_ledger('payments', row, lambda summary: summary.add_payment(amount, date, course, student_id))
         return payment_id
     except Exception as e:
         st.error(f"Error adding payment: {e}")
         return None
 
+@traced()
 def add_expense(title, amount, category):
-    """Add expense and clear cache"""
+    """Add expense and patch it into the cached expenses sheet"""
     try:
-        sheet = sheets['expenses']
         expense_id = get_next_id('expenses')
         date = datetime.now().strftime("%Y-%m-%d")
-        sheet.append_row([expense_id, title, amount, category, date])
-        clear_cache()
+        row = [expense_id, title, amount, category, date]
+        backend.append_row('expenses', row)
+        _patch_ledger('expenses', row, lambda summary: summary.add_expense(amount, date, category))
         return expense_id
     except Exception as e:
         st.error(f"Error adding expense: {e}")
         return None
 
+@traced()
 def add_investment(investor, amount, notes=""):
-    """Add investment and clear cache"""
+    """Add investment and patch it into the cached investments sheet"""
     try:
-        sheet = sheets['investments']
         investment_id = get_next_id('investments')
         date = datetime.now().strftime("%Y-%m-%d")
-        sheet.append_row([investment_id, investor, amount, date, notes])
-        clear_cache()
+        row = [investment_id, investor, amount, date, notes]
+        backend.append_row('investments', row)
+        _patch_ledger('investments', row, lambda summary: summary.add_investment(amount, investor))
         return investment_id
     except Exception as e:
         st.error(f"Error adding investment: {e}")
         return None
 
+@traced()
 def delete_row(sheet_name, row_id):
-    """Delete a row and clear cache"""
+    """Delete a row and drop it from that sheet's cache and the financial summary"""
     try:
-        sheet = sheets[sheet_name]
-        all_records = sheet.get_all_records()
-        for idx, record in enumerate(all_records, start=2):
-            if int(record['id']) == row_id:
-                sheet.delete_rows(idx)
-                clear_cache()
-                return True
+        record = get_row_index(sheet_name).get(row_id)
+        if record and sheet_name == 'payments':
+            # Resolved from the student index up front: inside update() a lookup through
+            # the summary would see the bumped payments version and rebuild it
+            student = get_student_index().get(_to_int(record.get('student_id')))
+            record = dict(record, course=student['course'] if student else None)
+        increments = []
+        if record and sheet_name == 'payments':
+            increments = [('students', _to_int(record['student_id']), 'paid', -float(record['amount']))]
+        if backend.delete_row(sheet_name, row_id, increments):
+            with summary_store.update() as summary:
+                cache_delete_row(sheet_name, row_id)
+                if summary and record:
+                    _unapply_from_summary(summary, sheet_name, record)
+                elif summary and sheet_name in SummaryStore.SHEETS:
+                    summary_store.invalidate()  # Row unknown here: nothing to subtract
+            return True
         return False
     except Exception as e:
         st.error(f"Error deleting: {e}")
         return False
 
+def _patch_ledger(sheet_name, row, apply):
+    """Patch a new ledger row into the cached sheet and, via apply(summary), the summary.
+
+    A row the cache already held was loaded by another session, maybe after the
+    summary was built, so the summary is rebuilt rather than patched or skipped.
+    """
+    with summary_store.update() as summary:
+        if cache_append_rows(sheet_name, [row]):
+            if summary:
+                apply(summary)
+        else:
+            summary_store.invalidate()
+
+def _unapply_from_summary(summary, sheet_name, record):
+    """Subtract a deleted ledger row from the rollups"""
+    if sheet_name == 'payments':
+        summary.add_payment(record['amount'], record['date'], record.get('course'),
+                            record['student_id'], sign=-1)
+    elif sheet_name == 'expenses':
+        summary.add_expense(record['amount'], record['date'], record['category'], sign=-1)
+    elif sheet_name == 'investments':
+        summary.add_investment(record['amount'], record['investor'], sign=-1)
+
+def get_row_index(sheet_name):
+    """id -> record for a sheet, built once per data version"""
+    def build():
+        index = {}
+        for record in get_all_data(sheet_name):
+            try:
+                index[int(record['id'])] = record
+            except (KeyError, TypeError, ValueError):
+                continue
+        return index
+    return memoize((sheet_name,), 'row_index', build)
+
+def get_student_index():
+    """id -> student record, built once per data version"""
+    return get_row_index('students')
+
 def get_student_by_id(student_id):
-    """Get student by ID from cached data"""
-    students_df = get_students_df()
-    if students_df.empty:
+    """Get student by ID from the memoised index, with paid taken from the ledger"""
+    try:
+        student = get_student_index().get(int(student_id))
+    except (TypeError, ValueError):
+        return None
+    if not student:
         return None
-    student = students_df[students_df['id'] == student_id]
-    return student.iloc[0].to_dict() if not student.empty else None
+    student = dict(student)
+    student['paid'] = get_financial_summary().paid_by_student.get(int(student_id), 0.0)
+    return student
+
+def student_names(student_ids):
+    """Vectorised id -> name lookup for a Series of student ids"""
+    names = memoize(('students',), 'student_names',
+                    lambda: {student_id: r['name'] for student_id, r in get_student_index().items()})
+    return student_ids.map(names).fillna('Unknown')
+
+def student_labels():
+    """id -> "id - name (Pending: ₹x)" picker labels, built vectorised once per data version"""
+    def build():
+        df = get_students_df()
+        pending = (df['fee'] - df['paid']).fillna(0).round().astype('int64').astype(str)
+        labels = df['id'].astype(str) + " - " + df['name'].astype(str) + " (Pending: ₹" + pending + ")"
+        return dict(zip(df['id'].astype('int64'), labels))
+    return memoize(('students', 'payments'), 'student_labels', build)
+
+# ================= SNAPSHOTS =================
+
+SNAPSHOT_FORMAT = 1      # Bump when the snapshot layout changes
+SNAPSHOT_INTERVAL = 60   # Minimum seconds between rewrites of one table's snapshot
+
+class SnapshotStore:
+    """Typed frames persisted as Feather files for a fast cold start.
+
+    Each <sheet>.feather has a <sheet>.json beside it with the format version, a
+    FRAME_SCHEMA fingerprint, the file's CRC32 and its watermark: the local table
+    version it was taken at (plus max id and the sync state). A snapshot is used
+    only when all of these match; otherwise the frame is rebuilt from SQLite.
+    """
+
+    def __init__(self, directory, local):
+        self.directory = directory
+        self.local = local
+        self.schema = zlib.crc32(repr(sorted(FRAME_SCHEMA.items())).encode())
+        self._lock = threading.Lock()
+        self.saved_at = {}
+        self.loads = 0
+        self.rejects = 0
+        self.saves = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, sheet_name):
+        base = os.path.join(self.directory, sheet_name)
+        return base + ".feather", base + ".json"
+
+    def _meta(self, sheet_name):
+        try:
+            with open(self._paths(sheet_name)[1]) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def load(self, sheet_name):
+        """The snapshot frame if it is intact and matches the local table, else None"""
+        meta = self._meta(sheet_name)
+        if (not meta or meta.get('format') != SNAPSHOT_FORMAT or meta.get('schema') != self.schema
+                or meta.get('table_version') != self.local.table_versions()[sheet_name]):
+            return None
+        try:
+            with open(self._paths(sheet_name)[0], 'rb') as f:
+                payload = f.read()
+            if zlib.crc32(payload) != meta['crc32']:
+                raise ValueError("checksum mismatch")
+            frame = pd.read_feather(BytesIO(payload))
+        except Exception:
+            self.rejects += 1  # Corrupt or unreadable: fall back to a full read
+            return None
+        self.loads += 1
+        return frame
+
+    def save(self, sheet_name, force=False):
+        """Write a fresh snapshot when the table changed (at most every SNAPSHOT_INTERVAL)"""
+        with self._lock:
+            meta = self._meta(sheet_name) or {}
+            if not force and time.time() - self.saved_at.get(sheet_name, 0) < SNAPSHOT_INTERVAL:
+                return False
+            self.saved_at[sheet_name] = time.time()
+            conn = self.local.connection()
+            conn.execute("BEGIN")  # Rows and version from the same read
+            try:
+                version = self.local.table_versions()[sheet_name]
+                if meta.get('table_version') == version and meta.get('schema') == self.schema:
+                    return False
+                frame = _typed_frame(sheet_name, self.local.fetch_all(sheet_name))
+            finally:
+                conn.execute("COMMIT")
+            buf = BytesIO()
+            frame.to_feather(buf)
+            payload = buf.getvalue()
+            data_path, meta_path = self._paths(sheet_name)
+            state = sync_engine.state.get(sheet_name, {}) if sync_engine is not None else {}
+            meta = {
+                'format': SNAPSHOT_FORMAT, 'schema': self.schema, 'crc32': zlib.crc32(payload),
+                'rows': len(frame), 'table_version': version, 'created': time.time(),
+                'max_id': int(frame['id'].max()) if len(frame) else 0,
+                'sync': {k: state[k] for k in ('high_water', 'rows_pulled', 'checksum') if k in state},
+            }
+            for path, content, mode in ((data_path, payload, 'wb'), (meta_path, json.dumps(meta), 'w')):
+                with open(path + ".tmp", mode) as f:
+                    f.write(content)
+                os.replace(path + ".tmp", path)  # Readers never see a half-written file
+            self.saves += 1
+            return True
+
+    def watermark(self, sheet_name):
+        """Sync state recorded with the last snapshot (restores SheetsSync counters)"""
+        return (self._meta(sheet_name) or {}).get('sync', {})
+
+    def stats(self):
+        return {'directory': self.directory, 'loads': self.loads, 'rejects': self.rejects, 'saves': self.saves}
+
+@st.cache_resource
+def init_snapshot_store():
+    """Snapshot store next to the SQLite file, or None when disabled / pyarrow is missing"""
+    directory = get_setting("snapshot_dir", None)
+    if str(directory).lower() in ("off", "false", "0") or not backend:
+        return None
+    try:
+        import pyarrow  # noqa: F401  (Feather support is optional)
+    except ImportError:
+        return None
+    local = getattr(backend, 'primary', backend)
+    try:
+        store = SnapshotStore(directory or f"{local.path}.snapshots", local)
+    except OSError as e:
+        st.warning(f"Snapshots disabled: {e}")
+        return None
+    if sync_engine is not None:
+        for sheet_name in SHEET_NAMES:
+            sync_engine.sheet_state(sheet_name).update(store.watermark(sheet_name))
+    return store
+
+snapshot_store = None  # Set by start_services()
+
+# ================= STUDENT SEARCH INDEX =================
+
+SEARCH_LIMIT = 200        # Ranked matches returned to a table or picker
+FUZZY_MIN_RATIO = 0.75    # difflib ratio for a typo-tolerant token match
+NON_DIGITS = re.compile(r"\D+")
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class StudentSearchIndex:
+    """Token, prefix and trigram index over student name, phone digits and course.
+
+    Each query term is matched against tokens as exact (rank 0), prefix (1), substring (2)
+    or fuzzy (3); a student must match every term and results are ordered by the summed
+    rank, then name. Digit-only terms match the normalised phone number or the id.
+    """
+
+    def __init__(self, students_df):
+        self.ids = students_df['id'].to_numpy()
+        self.names = students_df['name'].astype(str).tolist()
+        self.phones = students_df['phone'].astype(str).str.replace(NON_DIGITS, '', regex=True).tolist()
+        self._id_pos = {int(student_id): pos for pos, student_id in enumerate(self.ids)}
+        postings = defaultdict(set)
+        text = (students_df['name'].astype(str) + ' ' + students_df['course'].astype(str)).str.lower()
+        for pos, tokens in enumerate(text.str.split()):
+            for token in tokens:
+                postings[token].add(pos)
+        for pos, phone in enumerate(self.phones):
+            if phone:
+                postings[phone].add(pos)
+        self.postings = dict(postings)
+        self.tokens = sorted(self.postings)
+        self.token_grams = defaultdict(set)
+        for token in self.tokens:
+            # Padded so short and misspelt terms still share their first/last grams
+            for gram in _trigrams(f" {token} "):
+                self.token_grams[gram].add(token)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _prefixed(self, term):
+        start = bisect_left(self.tokens, term)
+        for token in self.tokens[start:]:
+            if not token.startswith(term):
+                break
+            yield token
+
+    def _term_ranks(self, term):
+        """pos -> best rank for one lower-cased query term"""
+        ranks = {}
+        def mark(tokens, rank):
+            for token in tokens:
+                for pos in self.postings[token]:
+                    if ranks.get(pos, rank + 1) > rank:
+                        ranks[pos] = rank
+        if term.isdigit() and int(term) in self._id_pos:
+            ranks[self._id_pos[int(term)]] = 0
+        mark([term] if term in self.postings else [], 0)
+        mark(self._prefixed(term), 1)
+        grams = _trigrams(term)
+        if grams:
+            candidates = set.intersection(*(self.token_grams.get(g, set()) for g in grams))
+            mark((t for t in candidates if term in t), 2)
+        if len(term) >= 4 and not term.isdigit():
+            grams = _trigrams(f" {term} ")
+            shared = defaultdict(int)
+            for gram in grams:
+                for token in self.token_grams.get(gram, ()):
+                    shared[token] += 1
+            close = [t for t, n in shared.items() if n * 3 >= len(grams)
+                     and difflib.SequenceMatcher(None, term, t).ratio() >= FUZZY_MIN_RATIO]
+            mark(close, 3)
+        return ranks
+
+    def search(self, query, limit=SEARCH_LIMIT, allowed=None):
+        """Ranked student ids matching query; allowed: optional set of ids to restrict to"""
+        terms = []
+        for term in str(query).lower().split():
+            digits = NON_DIGITS.sub('', term)
+            terms.append(digits if digits and len(digits) >= len(term) - 1 else term)
+        if not terms:
+            return []
+        scores = None
+        for term in terms:
+            ranks = self._term_ranks(term)
+            if scores is None:
+                scores = ranks
+            else:
+                scores = {pos: scores[pos] + rank for pos, rank in ranks.items() if pos in scores}
+            if not scores:
+                return []
+        ordered = sorted(scores, key=lambda pos: (scores[pos], self.names[pos].lower()))
+        results = []
+        for pos in ordered:
+            student_id = int(self.ids[pos])
+            if allowed is None or student_id in allowed:
+                results.append(student_id)
+                if limit and len(results) >= limit:
+                    break
+        return results
+
+def get_search_index():
+    """Student search index, built once per students data version"""
+    return memoize(('students',), 'search_index', lambda: StudentSearchIndex(get_students_df()))
+
+@traced()
+def search_students(query, limit=SEARCH_LIMIT, allowed=None):
+    """Ranked ids of students matching a name / phone / course query"""
+    return get_search_index().search(query, limit, allowed)
+
+def picker_candidates(query, dues_only=False, limit=SEARCH_LIMIT):
+    """Active student ids for the payment picker: search-ranked, or newest first without a query"""
+    def build():
+        df = get_students_df()
+        mask = df['status'] == 'active'
+        if dues_only:
+            mask &= (df['fee'] - df['paid']) > 0
+        return df.loc[mask, 'id'].astype('int64').tolist()[::-1]
+    eligible = memoize(('students', 'payments'), f"picker_ids_{'dues' if dues_only else 'all'}", build)
+    if query:
+        return search_students(query, limit, allowed=set(eligible))
+    return eligible[:limit]
+
+# ================= FINANCIAL SUMMARY =================
+
+class FinancialSummary:
+    """Daily, monthly, per-category, per-investor and per-course rollups of the ledgers"""
+
+    def __init__(self):
+        self.income_by_day = defaultdict(float)
+        self.expense_by_day = defaultdict(float)
+        self.income_by_month = defaultdict(float)
+        self.expense_by_month = defaultdict(float)
+        self.expense_by_category = defaultdict(float)
+        self.income_by_course = defaultdict(float)
+        self.investment_by_investor = defaultdict(float)
+        self.investment_count = defaultdict(int)
+        self.paid_by_student = defaultdict(float)
+        self.total_income = 0.0
+        self.total_expense = 0.0
+        self.total_investment = 0.0
+
+    @classmethod
+    def build(cls, payments_df, expenses_df, investments_df, students_df):
+        """Full build from the typed frames (vectorised, once per data change)"""
+        summary = cls()
+        day = lambda df: df['date'].dt.strftime('%Y-%m-%d')
+        month = lambda df: df['date'].dt.strftime('%Y-%m')
+        summary.income_by_day.update(payments_df.groupby(day(payments_df))['amount'].sum())
+        summary.income_by_month.update(payments_df.groupby(month(payments_df))['amount'].sum())
+        summary.expense_by_day.update(expenses_df.groupby(day(expenses_df))['amount'].sum())
+        summary.expense_by_month.update(expenses_df.groupby(month(expenses_df))['amount'].sum())
+        summary.expense_by_category.update(
+            expenses_df.groupby('category', observed=True)['amount'].sum())
+        investor_totals = investments_df.groupby('investor', observed=True)['amount'].agg(['sum', 'count'])
+        summary.investment_by_investor.update(investor_totals['sum'])
+        summary.investment_count.update(investor_totals['count'])
+        courses = payments_df['student_id'].map(students_df.drop_duplicates('id').set_index('id')['course'])
+        summary.income_by_course.update(payments_df.groupby(courses, observed=True)['amount'].sum())
+        summary.paid_by_student.update(
+            {int(k): v for k, v in payments_df.groupby('student_id')['amount'].sum().items()})
+        summary.total_income = float(payments_df['amount'].sum())
+        summary.total_expense = float(expenses_df['amount'].sum())
+        summary.total_investment = float(investments_df['amount'].sum())
+        return summary
+
+    @staticmethod
+    def _add(totals, key, amount):
+        totals[key] += amount
+        if abs(totals[key]) < 1e-9:
+            del totals[key]
+
+    def add_payment(self, amount, date, course, student_id=None, sign=1):
+        amount = sign * float(amount)
+        self._add(self.income_by_day, str(date)[:10], amount)
+        self._add(self.income_by_month, str(date)[:7], amount)
+        if course:
+            self._add(self.income_by_course, course, amount)
+        if student_id is not None:
+            self._add(self.paid_by_student, int(student_id), amount)
+        self.total_income += amount
+
+    def add_expense(self, amount, date, category, sign=1):
+        amount = sign * float(amount)
+        self._add(self.expense_by_day, str(date)[:10], amount)
+        self._add(self.expense_by_month, str(date)[:7], amount)
+        self._add(self.expense_by_category, category, amount)
+        self.total_expense += amount
+
+    def add_investment(self, amount, investor, sign=1):
+        amount = sign * float(amount)
+        self._add(self.investment_by_investor, investor, amount)
+        self.investment_count[investor] += sign
+        if self.investment_count[investor] <= 0:
+            del self.investment_count[investor]
+        self.total_investment += amount
+
+    def daily_frame(self):
+        """income / expense / profit per day, indexed by date"""
+        df = pd.DataFrame({'income': pd.Series(self.income_by_day, dtype='float64'),
+                           'expense': pd.Series(self.expense_by_day, dtype='float64')}).fillna(0)
+        df.index = pd.to_datetime(df.index)
+        df['profit'] = df['income'] - df['expense']
+        return df.sort_index()
+
+    def monthly_frame(self):
+        """income / expense / profit per month"""
+        df = pd.DataFrame({'income': pd.Series(self.income_by_month, dtype='float64'),
+                           'expense': pd.Series(self.expense_by_month, dtype='float64')}).fillna(0)
+        df['profit'] = df['income'] - df['expense']
+        return df.sort_index()
+
+
+class SummaryStore:
+    """Holds the FinancialSummary matching the current ledger versions.
+
+    Write paths patch the cache and the summary together inside update(); any
+    other change (sync, bulk import, refresh) shows up as a version mismatch
+    and triggers one full rebuild on the next read.
+    """
+    SHEETS = ('payments', 'expenses', 'investments')
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.summary = None
+        self.versions = None
+
+    def _versions(self):
+        return tuple(shared_cache.version(f"data_{sheet_name}") for sheet_name in self.SHEETS)
+
+    def get(self):
+        with self.lock:
+            versions = self._versions()
+            if self.summary is None or self.versions != versions:
+                prefetch()  # A cold dashboard loads all four sheets in one read
+                self.summary = FinancialSummary.build(
+                    get_payments_df(), get_expenses_df(), get_investments_df(), get_sheet_df('students'))
+                self.versions = versions
+            return self.summary
+
+    @contextmanager
+    def update(self):
+        """Yields the summary to patch (None when it is stale and will be rebuilt anyway)"""
+        with self.lock:
+            fresh = self.summary is not None and self.versions == self._versions()
+            yield self.summary if fresh else None
+            if fresh and self.summary is not None:
+                self.versions = self._versions()
+
+    def invalidate(self):
+        """Drop the summary; the next get() rebuilds it from the ledgers"""
+        with self.lock:
+            self.summary = None
+
+@st.cache_resource
+def init_summary_store():
+    """One summary store per server process"""
+    return SummaryStore()
+
+summary_store = None  # Set by start_services()
+
+def get_financial_summary():
+    """Pre-aggregated rollups for the dashboards"""
+    return summary_store.get()
+
+def reconcile_paid(repair=False):
+    """Compare the stored students.paid column with the payments ledger.
+
+    The app reads paid from the ledger; the stored column is a write-through copy
+    kept current by payments, payment deletes and imports (and mirrored to Sheets),
+    so drift means it was edited outside the app or predates the ledger totals.
+    Returns the drifted students (id, name, stored, ledger, difference); with
+    repair=True the stored column (and the Sheets mirror) is rewritten from the ledger.
+    """
+    students = _typed_frame('students', backend.fetch_all('students'))  # Stored values, not the cache
+    drift = pd.DataFrame({
+        'id': students['id'],
+        'name': students['name'],
+        'stored': students['paid'].fillna(0.0),
+        'ledger': students['id'].map(student_paid_totals()).fillna(0.0).astype('float64'),
+    })
+    drift['difference'] = drift['stored'] - drift['ledger']
+    drift = drift[drift['difference'].abs() > 0.005].reset_index(drop=True)
+    if repair and not drift.empty:
+        backend.write_batch(updates=[('students', int(r.id), 'paid', float(r.ledger))
+                                     for r in drift.itertuples()])
+        invalidate_cache('students')
+    return drift
+
+# ================= BULK IMPORT =================
+
+IMPORT_CHUNK_SIZE = 500  # Rows per write_batch (one transaction / one Sheets call each)
+IMPORT_COLUMNS = {
+    'students': ['name', 'phone', 'course', 'fee'],
+    'payments': ['student_id', 'amount', 'mode'],
+    'expenses': ['title', 'amount', 'category'],
+}
+
+def iter_import_records(uploaded_file):
+    """Yield one dict per row from a CSV (streamed) or Excel upload"""
+    if getattr(uploaded_file, 'name', '').lower().endswith(('.xlsx', '.xls')):
+        frame = pd.read_excel(uploaded_file, dtype=str).fillna('')  # Needs openpyxl
+        yield from frame.to_dict('records')
+    else:
+        yield from csv.DictReader(TextIOWrapper(uploaded_file, encoding='utf-8-sig'))
+
+def _import_row(kind, record, students):
+    """Validate one import record; returns the row without its id"""
+    record = {str(k).strip().lower(): str(v if v is not None else '').strip() for k, v in record.items()}
+    missing = [c for c in IMPORT_COLUMNS[kind] if not record.get(c)]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+    date = record.get('date') or datetime.now().strftime("%Y-%m-%d")
+    datetime.strptime(date, "%Y-%m-%d")
+    if kind == 'students':
+        fee = float(record['fee'])
+        if fee <= 0:
+            raise ValueError("fee must be positive")
+        return [record['name'], record['phone'], record['course'], fee, 0, record.get('status') or 'active', date]
+    amount = float(record['amount'])
+    if amount <= 0:
+        raise ValueError("amount must be positive")
+    if kind == 'payments':
+        student_id = int(float(record['student_id']))
+        if student_id not in students:
+            raise ValueError(f"unknown student {student_id}")
+        return [student_id, amount, record['mode'].lower(), date]
+    return [record['title'], amount, record['category'], date]
+
+@traced()
+def bulk_import(kind, records, progress=None):
+    """Validate records, reserve one id block and write them in chunked batches.
+
+    Returns (imported_count, [(line, error), ...]).
+    """
+    students = get_student_index() if kind == 'payments' else {}
+    rows, errors = [], []
+    for line, record in enumerate(records, start=2):  # Line 1 is the header
+        try:
+            rows.append(_import_row(kind, record, students))
+        except (ValueError, TypeError) as e:
+            errors.append((line, str(e)))
+    if not rows:
+        return 0, errors
+    
+    ids = reserve_id_block(kind, len(rows))
+    rows = [[row_id] + row for row_id, row in zip(ids, rows)]
+    for start in range(0, len(rows), IMPORT_CHUNK_SIZE):
+        backend.write_batch(appends=[(kind, row) for row in rows[start:start + IMPORT_CHUNK_SIZE]])
+        if progress:
+            progress(min(start + IMPORT_CHUNK_SIZE, len(rows)) / len(rows))
+    
+    if kind == 'payments':
+        # Keep the stored paid copy current: one increment per student after all rows
+        paid = defaultdict(float)
+        for row in rows:
+            paid[row[1]] += row[2]
+        backend.write_batch(increments=[('students', sid, 'paid', amount) for sid, amount in paid.items()])
+    invalidate_cache(kind)
+    return len(rows), errors
 
 # ================= CONFIG =================
 USERS = {"Arghya": "Arghya@9382", "Tapan": "Tapan@6296", "Suman": "Suman@8348"}
 UPI_ID = "yourupi@bank"
 INVESTORS = ["Arghya", "Tapan", "Suman"]
+ADMINS = {"Arghya"}  # Users who see the diagnostics page
 
 if "logged_in" not in st.session_state:
     st.session_state.logged_in = False
@@ -317,62 +2453,73 @@ if "logged_in" not in st.session_state:
 
 # ================= HELPER FUNCTIONS =================
 
-def generate_receipt(student_id, amount, mode):
+@traced()
+def generate_receipt(student_id, amount, mode, payment_id):
     """Generate PDF receipt"""
     student = get_student_by_id(student_id)
     if not student:
         return None
     
-    buf = BytesIO()
-    doc = SimpleDocTemplate(buf, pagesize=A4)
-    styles = getSampleStyleSheet()
-    elems = []
-    
-    title = Paragraph("<b>COACHING FEE RECEIPT</b>", styles["Title"])
-    elems.append(title)
-    elems.append(Spacer(1, 30))
-    
-    data = [
-        ["Receipt ID:", f"RCP-{student_id}-{datetime.now().strftime('%Y%m%d%H%M')}"],
-        ["Student Name:", str(student['name'])],
-        ["Course:", str(student['course'])],
-        ["Phone:", str(student['phone'])],
-        ["Amount Paid:", f"₹ {amount:.2f}"],
-        ["Payment Mode:", mode.upper()],
-        ["Date:", datetime.now().strftime("%d-%m-%Y %I:%M %p")],
-    ]
-    
-    table = Table(data, colWidths=[150, 300])
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (0, -1), colors.HexColor('#667eea')),
-        ('TEXTCOLOR', (0, 0), (0, -1), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
-        ('FONTSIZE', (0, 0), (-1, -1), 12),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
-        ('TOPPADDING', (0, 0), (-1, -1), 12),
-        ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-        ('BOX', (0, 0), (-1, -1), 2, colors.HexColor('#667eea')),
-    ]))
-    
-    elems.append(table)
-    elems.append(Spacer(1, 40))
-    footer = Paragraph("<i>Thank you for your payment!</i>", styles["Normal"])
-    elems.append(footer)
-    
-    doc.build(elems)
-    buf.seek(0)
-    return buf
+    pdf = receipt_engine.render_receipt({
+        'payment_id': payment_id,
+        'name': student['name'],
+        'course': student['course'],
+        'phone': student['phone'],
+        'amount': amount,
+        'mode': mode,
+        'date': datetime.now().strftime("%d-%m-%Y %I:%M %p"),
+    })
+    return BytesIO(pdf)
 
+def payment_receipts(payments_df):
+    """Receipt dicts for re-issuing the given payments"""
+    students = get_student_index()
+    receipts = []
+    for payment in payments_df.to_dict('records'):
+        student = students.get(payment['student_id'], {})
+        receipts.append({
+            'payment_id': payment['id'],
+            'name': student.get('name', 'Unknown'),
+            'course': student.get('course', ''),
+            'phone': student.get('phone', ''),
+            'amount': payment['amount'],
+            'mode': payment['mode'],
+            'date': payment['date'].strftime("%d-%m-%Y") if pd.notna(payment['date']) else '',
+        })
+    return receipts
+
+QR_SIZE = 300            # Target width/height in pixels
+QR_CACHE_SIZE = 256
+QR_PREWARM_COUNT = 12
+
+@st.cache_resource(max_entries=QR_CACHE_SIZE, show_spinner=False)
+def upi_qr_png(upi_id, amount):
+    """PNG bytes of a UPI QR code, shared across sessions (LRU-bounded)"""
+    import qrcode  # Loaded the first time a UPI payment needs a code
+    link = f"upi://pay?pa={upi_id}&pn=CoachingCentre&am={amount}&cu=INR"
+    qr = qrcode.QRCode(border=4)
+    qr.add_data(link)
+    qr.make(fit=True)
+    # Pick the module size that lands closest to QR_SIZE instead of resampling afterwards
+    qr.box_size = max(1, round(QR_SIZE / (qr.modules_count + 2 * qr.border)))
+    b = BytesIO()
+    qr.make_image().save(b, format="PNG")
+    return b.getvalue()
+
+@traced()
 def upi_qr(amount):
     """Generate UPI QR code"""
-    link = f"upi://pay?pa={UPI_ID}&pn=CoachingCentre&am={amount}&cu=INR"
-    img = qrcode.make(link)
-    img = img.resize((300, 300))
-    b = BytesIO()
-    img.save(b, format="PNG")
-    b.seek(0)
-    return b
+    return upi_qr_png(UPI_ID, round(float(amount), 2))
+
+def prewarm_upi_qr():
+    """Render QR codes for the most common amounts on a background thread"""
+    payments_df = get_payments_df()
+    students_df = get_students_df()
+    amounts = pd.concat([payments_df['amount'], students_df['fee'] - students_df['paid']]).dropna()
+    amounts = amounts[amounts > 0].value_counts().head(QR_PREWARM_COUNT).index
+    thread = threading.Thread(target=lambda: [upi_qr(amount) for amount in amounts], daemon=True)
+    thread.start()
+    return thread
 
 def whatsapp_link(phone, msg):
     """Generate WhatsApp link"""
@@ -381,6 +2528,10 @@ def whatsapp_link(phone, msg):
         clean_phone = "91" + clean_phone
     return f"https://wa.me/{clean_phone}?text={urllib.parse.quote(msg)}"
 
+def date_column(*labels):
+    """column_config rendering datetime columns as plain dates"""
+    return {label: st.column_config.DateColumn(label, format="YYYY-MM-DD") for label in labels}
+
 def metric_card(label, value, icon="📊"):
     return f"""<div class="metric-card">
         <div style="font-size: 2rem;">{icon}</div>
@@ -425,27 +2576,70 @@ def login_page():
 
 # ================= DASHBOARD PAGES =================
 
+@st.fragment
+def bulk_import_section(kind):
+    """CSV/Excel upload feeding bulk_import"""
+    with st.expander("📥 Bulk Import (CSV / Excel)", expanded=False):
+        columns = ", ".join(IMPORT_COLUMNS[kind])
+        st.caption(f"Required columns: {columns}. Optional: date (YYYY-MM-DD).")
+        upload = st.file_uploader("Import file", type=["csv", "xlsx", "xls"], key=f"import_{kind}")
+        if upload and st.button("📥 Import", key=f"import_btn_{kind}", use_container_width=True):
+            bar = st.progress(0.0)
+            try:
+                imported, errors = bulk_import(kind, iter_import_records(upload), bar.progress)
+            except ImportError:
+                st.error("Reading Excel files needs the openpyxl package; upload a CSV instead.")
+                return
+            except Exception as e:
+                st.error(f"Import failed: {e}")
+                return
+            if errors:
+                st.warning(f"Skipped {len(errors)} invalid rows")
+                st.dataframe(pd.DataFrame(errors, columns=['Line', 'Problem']), hide_index=True)
+            if imported:
+                st.success(f"✅ Imported {imported} {kind}!")
+                time.sleep(1)
+                st.rerun()
+
+@st.fragment
+def delete_section(sheet_name, label, key=None):
+    """Delete-by-ID control; reruns on its own until a row is actually deleted"""
+    st.markdown("---")
+    st.markdown(f"### 🗑️ Delete {label}")
+    col1, col2 = st.columns([2, 2])
+    with col1:
+        delete_id = st.number_input(f"{label} ID to Delete", min_value=1, step=1, key=key)
+    with col2:
+        st.write("")
+        st.write("")
+        if st.button(f"🗑️ Delete {label}", type="secondary", use_container_width=True):
+            if delete_row(sheet_name, int(delete_id)):
+                st.success(f"✅ {label} ID {delete_id} deleted!")
+                time.sleep(1)
+                st.rerun()
+            else:
+                st.error(f"❌ {label} ID {delete_id} not found!")
+
 def overview_page():
-    if not sheets:
-        st.error("⚠️ Google Sheets not connected.")
+    if not backend:
+        st.error("⚠️ Database not connected.")
         return
     
     st.markdown("# 🏠 LogicRoot")
     
     # Add refresh button
     if st.button("🔄 Refresh Data"):
-        clear_cache()
-        st.rerun()
+        refresh_worker.request(*SHEET_NAMES, force=True)
+        st.toast("🔄 Refreshing in the background")
     
     students_df = get_students_df()
     payments_df = get_payments_df()
-    expenses_df = get_expenses_df()
-    investments_df = get_investments_df()
+    summary = get_financial_summary()
     
     total_students = len(students_df[students_df['status'] == 'active']) if not students_df.empty else 0
-    total_income = float(payments_df['amount'].sum()) if not payments_df.empty else 0
-    total_expense = float(expenses_df['amount'].sum()) if not expenses_df.empty else 0
-    total_investment = float(investments_df['amount'].sum()) if not investments_df.empty else 0
+    total_income = summary.total_income
+    total_expense = summary.total_expense
+    total_investment = summary.total_investment
     profit = total_income - total_expense
     
     col1, col2, col3, col4 = st.columns(4)
@@ -466,8 +2660,8 @@ def overview_page():
     with col1:
         st.markdown(metric_card("Total Investment", f"₹{total_investment:,.0f}", "💼"), unsafe_allow_html=True)
     
-    if not investments_df.empty:
-        investor_totals = investments_df.groupby('investor')['amount'].sum().to_dict()
+    if summary.investment_by_investor:
+        investor_totals = summary.investment_by_investor
         cols = [col2, col3, col4]
         for idx, investor in enumerate(INVESTORS):
             if idx < len(cols):
@@ -480,18 +2674,16 @@ def overview_page():
     
     if not payments_df.empty and not students_df.empty:
         recent = payments_df.tail(5).copy()
-        recent['student_name'] = recent['student_id'].apply(
-            lambda x: get_student_by_id(int(x))['name'] if get_student_by_id(int(x)) else 'Unknown'
-        )
+        recent['student_name'] = student_names(recent['student_id'])
         recent = recent[['date', 'student_name', 'amount', 'mode']]
         recent.columns = ['Date', 'Student', 'Amount', 'Mode']
-        st.dataframe(recent, use_container_width=True, hide_index=True)
+        st.dataframe(recent, use_container_width=True, hide_index=True, column_config=date_column('Date'))
     else:
         st.info("No payments recorded yet")
 
 def students_page():
-    if not sheets:
-        st.error("⚠️ Google Sheets not connected.")
+    if not backend:
+        st.error("⚠️ Database not connected.")
         return
     
     st.markdown("# 🎓 Student Management")
@@ -518,39 +2710,14 @@ def students_page():
                 else:
                     st.error("Please fill all required fields")
     
+    bulk_import_section('students')
+    
     st.markdown("### 📋 All Students")
     students_df = get_students_df()
     
     if not students_df.empty:
-        display_df = students_df.copy()
-        display_df['pending'] = display_df['fee'] - display_df['paid']
-        display_df = display_df[['id', 'name', 'phone', 'course', 'fee', 'paid', 'pending', 'status', 'date']]
-        display_df.columns = ['ID', 'Name', 'Phone', 'Course', 'Total Fee', 'Paid', 'Pending', 'Status', 'Enrolled']
-        
-        search = st.text_input("🔍 Search students", placeholder="Search by name or phone")
-        if search:
-            display_df = display_df[
-                display_df['Name'].astype(str).str.contains(search, case=False, na=False) |
-                display_df['Phone'].astype(str).str.contains(search, case=False, na=False)
-            ]
-        
-        st.dataframe(display_df, use_container_width=True, hide_index=True)
-        
-        st.markdown("---")
-        st.markdown("### 🗑️ Delete Student")
-        col1, col2 = st.columns([2, 2])
-        with col1:
-            delete_id = st.number_input("Student ID to Delete", min_value=1, step=1)
-        with col2:
-            st.write("")
-            st.write("")
-            if st.button("🗑️ Delete Student", type="secondary", use_container_width=True):
-                if delete_row('students', int(delete_id)):
-                    st.success(f"✅ Student ID {delete_id} deleted!")
-                    time.sleep(1)
-                    st.rerun()
-                else:
-                    st.error(f"❌ Student ID {delete_id} not found!")
+        students_table()
+        delete_section('students', "Student")
         
         st.markdown("---")
         col1, col2, col3 = st.columns(3)
@@ -560,9 +2727,70 @@ def students_page():
     else:
         st.info("No students added yet.")
 
+PAGE_SIZES = [25, 50, 100]
+STUDENT_SORT = {'Relevance': None, 'ID': 'id', 'Name': 'name', 'Course': 'course', 'Total Fee': 'fee',
+                'Paid': 'paid', 'Pending': 'pending', 'Enrolled': 'date'}
+
+def paginate(total, page_size, key):
+    """Page picker; returns the row offset of the chosen page"""
+    pages = max(1, -(-total // page_size))
+    col1, col2 = st.columns([1, 3])
+    page = col1.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1, step=1, key=key)
+    offset = (page - 1) * page_size
+    col2.caption(f"Showing {min(offset + 1, total)}–{min(offset + page_size, total)} of {total}")
+    return offset
+
+@st.fragment
+def students_table():
+    """Filtered, sorted student table; only the visible page is queried and sent"""
+    students_df = get_students_df()
+    col1, col2, col3, col4 = st.columns([3, 2, 2, 1])
+    search = col1.text_input("🔍 Search students", placeholder="Search by name, phone or course")
+    courses = col2.multiselect("Course", list(students_df['course'].cat.categories))
+    status = col3.selectbox("Status", ["All"] + list(students_df['status'].cat.categories))
+    with col4:
+        st.write("")
+        pending_only = st.checkbox("Dues", help="Only students with pending fees")
+    col1, col2, col3 = st.columns([2, 1, 1])
+    sort_label = col1.selectbox("Sort by", list(STUDENT_SORT))
+    with col2:
+        st.write("")
+        descending = st.toggle("Descending")
+    page_size = col3.selectbox("Rows", PAGE_SIZES, index=1)
+    
+    matches = search_students(search, limit=None) if search.strip() else None  # Every match, ranked
+    filters = {
+        'id': matches,
+        'course': courses or None,
+        'status': None if status == "All" else status,
+        'pending_min': 0 if pending_only else None,
+    }
+    if matches is not None and STUDENT_SORT[sort_label] is None:
+        # Rank order only exists in the search index: page through the ranked ids
+        # and fetch just the visible ones from SQLite
+        narrowed = {key: value for key, value in filters.items() if key != 'id' and value is not None}
+        if narrowed:
+            allowed = set(local_store().ids('students', narrowed))
+            matches = [student_id for student_id in matches if student_id in allowed]
+        ranked = matches[::-1] if descending else matches
+        offset = paginate(len(ranked), page_size, key="students_page_no")
+        page = ranked[offset:offset + page_size]
+        rank = {student_id: i for i, student_id in enumerate(page)}
+        display_df = query_rows('students', {'id': page}, 'id', False, 0, len(page))
+        display_df = display_df.sort_values('id', key=lambda ids: ids.map(rank))
+    else:
+        total = count_rows('students', filters)
+        offset = paginate(total, page_size, key="students_page_no")
+        display_df = query_rows('students', filters, STUDENT_SORT[sort_label] or 'id', descending, offset, page_size)
+    display_df = display_df[['id', 'name', 'phone', 'course', 'fee', 'paid', 'pending', 'status', 'date']]
+    display_df.columns = ['ID', 'Name', 'Phone', 'Course', 'Total Fee', 'Paid', 'Pending', 'Status', 'Enrolled']
+    
+    st.dataframe(display_df, use_container_width=True, hide_index=True,
+                 column_config=date_column('Enrolled'))
+
 def payments_page():
-    if not sheets:
-        st.error("⚠️ Google Sheets not connected.")
+    if not backend:
+        st.error("⚠️ Database not connected.")
         return
     
     st.markdown("# 💰 Payment Collection")
@@ -574,87 +2802,136 @@ def payments_page():
         st.warning("⚠️ No active students found.")
         return
     
+    memoize(('payments', 'students'), 'qr_prewarm', prewarm_upi_qr)  # Once per data version
+    payment_form()
+    bulk_import_section('payments')
+    
+    st.markdown("---")
+    st.markdown("### 📊 Recent Payments")
+    
+    payments_df = get_payments_df()
+    if not payments_df.empty:
+        payments_table()
+        reissue_receipts_section()
+        delete_section('payments', "Payment", key="del_pay")
+    else:
+        st.info("No payments recorded yet")
+
+@st.fragment
+def payments_table():
+    """Newest payments first, filtered by date range / mode and paginated in SQLite"""
+    col1, col2, col3, col4 = st.columns([1, 1, 2, 1])
+    date_from = col1.date_input("From", value=None, key="payments_from")
+    date_to = col2.date_input("To", value=None, key="payments_to")
+    modes = col3.multiselect("Mode", list(get_payments_df()['mode'].cat.categories))
+    page_size = col4.selectbox("Rows", [20] + PAGE_SIZES, key="payments_rows")
+    
+    filters = {'date_from': date_from, 'date_to': date_to, 'mode': modes or None}
+    total = count_rows('payments', filters)
+    offset = paginate(total, page_size, key="payments_page_no")
+    recent = query_rows('payments', filters, 'id', True, offset, page_size)
+    recent['student_name'] = student_names(recent['student_id'])
+    recent = recent[['id', 'date', 'student_name', 'amount', 'mode']]
+    recent.columns = ['ID', 'Date', 'Student', 'Amount', 'Mode']
+    st.dataframe(recent, use_container_width=True, hide_index=True, column_config=date_column('Date'))
+
+@st.fragment
+def reissue_receipts_section():
+    """Batch re-issue of receipts for a date range"""
+    st.markdown("---")
+    with st.expander("🧾 Re-issue Receipts", expanded=False):
+        payments_df = get_payments_df()
+        today = datetime.now().date()
+        col1, col2, col3 = st.columns(3)
+        start = col1.date_input("From", value=today.replace(day=1), key="receipts_from")
+        end = col2.date_input("To", value=today, key="receipts_to")
+        as_zip = col3.radio("Format", ["Single PDF", "ZIP"], horizontal=True) == "ZIP"
+        
+        dates = payments_df['date'].dt.date
+        selected = payments_df[(dates >= start) & (dates <= end)]
+        st.caption(f"{len(selected)} payments in range")
+        if not selected.empty and st.button("🧾 Generate Receipts", use_container_width=True):
+            with st.spinner("Rendering receipts..."):
+                receipts = payment_receipts(selected)
+                if as_zip:
+                    data, name, mime = receipt_engine.render_receipts_zip(receipts), "zip", "application/zip"
+                else:
+                    data, name, mime = receipt_engine.render_combined_pdf(receipts), "pdf", "application/pdf"
+            st.download_button("📥 Download", data, f"receipts_{start:%Y%m%d}_{end:%Y%m%d}.{name}",
+                               mime, use_container_width=True)
+
+PICKER_PAGE = 50  # Student options sent to the payment picker per "Show more"
+
+def show_more_students():
+    st.session_state.picker_shown += PICKER_PAGE
+
+@st.fragment
+def payment_form():
+    """Payment form; submitting it only reruns this fragment until the payment is saved"""
+    col1, col2 = st.columns([3, 1])
+    query = col1.text_input("🔍 Find student", placeholder="Type a name, phone, course or ID",
+                            key="payment_student_search").strip()
+    with col2:
+        st.write("")
+        dues_only = st.checkbox("Pending dues only", key="payment_dues_only")
+    
+    # Only PICKER_PAGE options go to the browser; "Show more" extends the list
+    if st.session_state.get('picker_filter') != (query, dues_only):
+        st.session_state.picker_filter = (query, dues_only)
+        st.session_state.picker_shown = PICKER_PAGE
+    shown = st.session_state.picker_shown
+    candidates = picker_candidates(query, dues_only, limit=shown + 1)
+    if len(candidates) > shown:
+        col1, col2 = st.columns([3, 1])
+        col1.caption(f"Showing the first {shown} matches; type to narrow the list.")
+        col2.button("Show more", key="picker_more", use_container_width=True, on_click=show_more_students)
+    candidates = candidates[:shown]
+    labels = student_labels()
+    
     with st.form("payment_form"):
         col1, col2 = st.columns(2)
-        
+    
         with col1:
-            student_options = {}
-            for _, student in active_students.iterrows():
-                pending = student['fee'] - student['paid']
-                label = f"{int(student['id'])} - {student['name']} (Pending: ₹{pending:.0f})"
-                student_options[label] = int(student['id'])
-            
-            selected_student = st.selectbox("Select Student*", options=list(student_options.keys()))
-            student_id = student_options[selected_student] if selected_student else None
+            student_id = st.selectbox("Select Student*", options=candidates, format_func=labels.get,
+                                      placeholder="No matching students")
             amount = st.number_input("Amount (₹)*", min_value=0.0, step=100.0)
-        
+    
         with col2:
             mode = st.selectbox("Payment Mode*", ["Cash", "UPI", "Online Transfer", "Cheque"])
             st.write("")
             st.write("")
             submit = st.form_submit_button("💳 Record Payment", use_container_width=True)
-        
+    
         if mode == "UPI" and amount > 0:
             st.markdown("---")
             st.markdown("### 📱 Scan to Pay")
             col1, col2, col3 = st.columns([1, 2, 1])
             with col2:
                 st.image(upi_qr(amount), caption=f"Pay ₹{amount:.2f}")
-        
+    
         if submit and student_id and amount > 0:
             payment_id = add_payment(student_id, amount, mode.lower())
             if payment_id:
                 st.success(f"✅ Payment of ₹{amount:.2f} recorded!")
-                
-                receipt = generate_receipt(student_id, amount, mode)
+            
+                receipt = generate_receipt(student_id, amount, mode, payment_id)
                 if receipt:
                     st.download_button("📄 Download Receipt", receipt,
-                        f"receipt_{student_id}_{datetime.now().strftime('%Y%m%d')}.pdf",
+                        f"{receipt_engine.receipt_number(payment_id)}.pdf",
                         "application/pdf", use_container_width=True)
-                
+            
                 student = get_student_by_id(student_id)
                 if student:
                     msg = f"Dear {student['name']}, your payment of ₹{amount:.2f} has been received. Thank you!"
                     wa_link = whatsapp_link(student['phone'], msg)
                     st.markdown(f'<a href="{wa_link}" target="_blank" class="whatsapp-link">📱 Send WhatsApp Receipt</a>', unsafe_allow_html=True)
-                
+            
                 time.sleep(1)
                 st.rerun()
-    
-    st.markdown("---")
-    st.markdown("### 📊 Recent Payments")
-    
-    payments_df = get_payments_df()
-    if not payments_df.empty:
-        recent = payments_df.tail(20).copy()
-        recent['student_name'] = recent['student_id'].apply(
-            lambda x: get_student_by_id(int(x))['name'] if get_student_by_id(int(x)) else 'Unknown'
-        )
-        recent = recent[['id', 'date', 'student_name', 'amount', 'mode']]
-        recent.columns = ['ID', 'Date', 'Student', 'Amount', 'Mode']
-        st.dataframe(recent, use_container_width=True, hide_index=True)
-        
-        st.markdown("---")
-        st.markdown("### 🗑️ Delete Payment")
-        col1, col2 = st.columns([2, 2])
-        with col1:
-            delete_id = st.number_input("Payment ID to Delete", min_value=1, step=1, key="del_pay")
-        with col2:
-            st.write("")
-            st.write("")
-            if st.button("🗑️ Delete Payment", type="secondary", use_container_width=True):
-                if delete_row('payments', int(delete_id)):
-                    st.success(f"✅ Payment ID {delete_id} deleted!")
-                    time.sleep(1)
-                    st.rerun()
-                else:
-                    st.error(f"❌ Payment ID {delete_id} not found!")
-    else:
-        st.info("No payments recorded yet")
 
 def expenses_page():
-    if not sheets:
-        st.error("⚠️ Google Sheets not connected.")
+    if not backend:
+        st.error("⚠️ Database not connected.")
         return
     
     st.markdown("# 📉 Expense Management")
@@ -680,42 +2957,29 @@ def expenses_page():
                     time.sleep(1)
                     st.rerun()
     
+    bulk_import_section('expenses')
+    
     st.markdown("### 📋 All Expenses")
     expenses_df = get_expenses_df()
     
     if not expenses_df.empty:
         display_df = expenses_df[['id', 'date', 'title', 'category', 'amount']].copy()
         display_df.columns = ['ID', 'Date', 'Title', 'Category', 'Amount']
-        st.dataframe(display_df, use_container_width=True, hide_index=True)
-        
-        st.markdown("---")
-        st.markdown("### 🗑️ Delete Expense")
-        col1, col2 = st.columns([2, 2])
-        with col1:
-            delete_id = st.number_input("Expense ID to Delete", min_value=1, step=1, key="del_exp")
-        with col2:
-            st.write("")
-            st.write("")
-            if st.button("🗑️ Delete Expense", type="secondary", use_container_width=True):
-                if delete_row('expenses', int(delete_id)):
-                    st.success(f"✅ Expense ID {delete_id} deleted!")
-                    time.sleep(1)
-                    st.rerun()
-                else:
-                    st.error(f"❌ Expense ID {delete_id} not found!")
+        st.dataframe(display_df, use_container_width=True, hide_index=True, column_config=date_column('Date'))
+        delete_section('expenses', "Expense", key="del_exp")
         
         st.markdown("---")
         col1, col2 = st.columns(2)
         col1.metric("Total Expenses", f"₹{expenses_df['amount'].sum():,.0f}")
         current_month = datetime.now().strftime('%Y-%m')
-        month_expenses = expenses_df[expenses_df['date'].astype(str).str.startswith(current_month)]
-        col2.metric("This Month", f"₹{month_expenses['amount'].sum():,.0f}")
+        month_expenses = get_financial_summary().expense_by_month.get(current_month, 0)
+        col2.metric("This Month", f"₹{month_expenses:,.0f}")
     else:
         st.info("No expenses recorded yet")
 
 def investments_page():
-    if not sheets:
-        st.error("⚠️ Google Sheets not connected.")
+    if not backend:
+        st.error("⚠️ Database not connected.")
         return
     
     st.markdown("# 💼 Investment Management")
@@ -744,19 +3008,17 @@ def investments_page():
     if not investments_df.empty:
         display_df = investments_df[['id', 'date', 'investor', 'amount', 'notes']].copy()
         display_df.columns = ['ID', 'Date', 'Investor', 'Amount', 'Notes']
-        st.dataframe(display_df, use_container_width=True, hide_index=True)
+        st.dataframe(display_df, use_container_width=True, hide_index=True, column_config=date_column('Date'))
         
         st.markdown("---")
         st.markdown("### 💰 Investment Summary by Partner")
         
-        investor_summary = investments_df.groupby('investor')['amount'].agg(['sum', 'count']).reset_index()
-        investor_summary.columns = ['Investor', 'Total Investment', 'Number of Investments']
+        summary = get_financial_summary()
         
         col1, col2, col3 = st.columns(3)
         for idx, investor in enumerate(INVESTORS):
-            investor_data = investor_summary[investor_summary['Investor'] == investor]
-            total = float(investor_data.iloc[0]['Total Investment']) if not investor_data.empty else 0
-            count = int(investor_data.iloc[0]['Number of Investments']) if not investor_data.empty else 0
+            total = float(summary.investment_by_investor.get(investor, 0))
+            count = int(summary.investment_count.get(investor, 0))
             
             with [col1, col2, col3][idx]:
                 st.markdown(f"""<div class="investor-card">
@@ -766,21 +3028,7 @@ def investments_page():
                     <p style="color: white; margin-top: 0.5rem; font-size: 0.9rem;">{count} investments</p>
                 </div>""", unsafe_allow_html=True)
         
-        st.markdown("---")
-        st.markdown("### 🗑️ Delete Investment")
-        col1, col2 = st.columns([2, 2])
-        with col1:
-            delete_id = st.number_input("Investment ID to Delete", min_value=1, step=1, key="del_inv")
-        with col2:
-            st.write("")
-            st.write("")
-            if st.button("🗑️ Delete Investment", type="secondary", use_container_width=True):
-                if delete_row('investments', int(delete_id)):
-                    st.success(f"✅ Investment ID {delete_id} deleted!")
-                    time.sleep(1)
-                    st.rerun()
-                else:
-                    st.error(f"❌ Investment ID {delete_id} not found!")
+        delete_section('investments', "Investment", key="del_inv")
         
         st.markdown("---")
         col1, col2, col3 = st.columns(3)
@@ -791,93 +3039,202 @@ def investments_page():
         st.info("No investments recorded yet")
 
 def analytics_page():
-    if not sheets:
-        st.error("⚠️ Google Sheets not connected.")
+    if not backend:
+        st.error("⚠️ Database not connected.")
         return
     
     st.markdown("# 📊 Financial Analytics")
     
-    payments_df = get_payments_df()
-    expenses_df = get_expenses_df()
-    investments_df = get_investments_df()
+    summary = get_financial_summary()
     
     st.markdown("### 📈 Income vs Expense Trend")
     
-    if not payments_df.empty or not expenses_df.empty:
-        income_by_date = payments_df.groupby('date')['amount'].sum().reset_index() if not payments_df.empty else pd.DataFrame(columns=['date', 'amount'])
-        income_by_date.columns = ['date', 'income'] if not income_by_date.empty else ['date', 'income']
-        
-        expense_by_date = expenses_df.groupby('date')['amount'].sum().reset_index() if not expenses_df.empty else pd.DataFrame(columns=['date', 'amount'])
-        expense_by_date.columns = ['date', 'expense'] if not expense_by_date.empty else ['date', 'expense']
-        
-        df = pd.merge(income_by_date, expense_by_date, on="date", how="outer").fillna(0)
-        df['profit'] = df['income'] - df['expense']
+    if summary.income_by_day or summary.expense_by_day:
+        df = summary.daily_frame()
         
-        st.line_chart(df.set_index("date")[['income', 'expense', 'profit']])
+        st.line_chart(df[['income', 'expense', 'profit']])
         
         col1, col2, col3, col4 = st.columns(4)
-        total_income = float(df['income'].sum())
-        total_expense = float(df['expense'].sum())
-        total_investment = float(investments_df['amount'].sum()) if not investments_df.empty else 0
+        total_income = summary.total_income
+        total_expense = summary.total_expense
+        total_investment = summary.total_investment
         
         col1.metric("Total Income", f"₹{total_income:,.0f}")
         col2.metric("Total Expense", f"₹{total_expense:,.0f}")
         col3.metric("Total Investment", f"₹{total_investment:,.0f}")
         col4.metric("Net Profit", f"₹{(total_income - total_expense):,.0f}")
+        
+        st.markdown("---")
+        st.markdown("### 📅 Monthly Summary")
+        st.bar_chart(summary.monthly_frame()[['income', 'expense']])
     else:
         st.info("Not enough data for analysis yet")
     
     st.markdown("---")
     st.markdown("### 📊 Expense Breakdown by Category")
     
-    if not expenses_df.empty:
-        category_total = expenses_df.groupby('category')['amount'].sum().reset_index()
-        category_total.columns = ['category', 'total']
-        st.bar_chart(category_total.set_index('category'))
+    if summary.expense_by_category:
+        category_total = pd.Series(summary.expense_by_category, name='total').rename_axis('category')
+        st.bar_chart(category_total.to_frame())
     else:
         st.info("No expense data available")
     
-    if not investments_df.empty:
+    if summary.income_by_course:
+        st.markdown("---")
+        st.markdown("### 🎓 Income by Course")
+        course_total = pd.Series(summary.income_by_course, name='total').rename_axis('course')
+        st.bar_chart(course_total.to_frame())
+    
+    if summary.investment_by_investor:
         st.markdown("---")
         st.markdown("### 💼 Investment Distribution by Partner")
-        investor_total = investments_df.groupby('investor')['amount'].sum().reset_index()
-        investor_total.columns = ['investor', 'total']
-        st.bar_chart(investor_total.set_index('investor'))
+        investor_total = pd.Series(summary.investment_by_investor, name='total').rename_axis('investor')
+        st.bar_chart(investor_total.to_frame())
+
+def diagnostics_page():
+    """Admin-only view of span timings, cache efficiency and background workers"""
+    st.markdown("# 🩺 Diagnostics")
+    
+    runs = list(tracer.runs)
+    last = runs[-1] if runs else None  # This rerun is recorded once it finishes
+    cache = shared_cache.stats()
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Reruns traced", tracer.reruns)
+    col2.metric("Last rerun", f"{last['total_ms']:.0f} ms" if last else "—")
+    col3.metric("Cache hit rate", f"{cache['hit_rate']:.0%}", f"{cache['stale_hits']} stale")
+    col4.metric("Remote calls", sum(tracer.remote_calls.values()))
+    
+    st.markdown("### ⏱️ Spans (since start)")
+    st.dataframe(pd.DataFrame(tracer.span_table()), use_container_width=True, hide_index=True,
+                 column_config={c: st.column_config.NumberColumn(format="%.2f")
+                                for c in ('total_ms', 'mean_ms', 'max_ms')})
+    
+    if runs:
+        st.markdown("### 🔁 Recent reruns")
+        recent = pd.DataFrame([{
+            'page': run['label'], 'at': datetime.fromtimestamp(run['started']).strftime("%H:%M:%S"),
+            'total_ms': round(run['total_ms'], 1), 'spans': len(run['spans']),
+            'remote_calls': run['remote_calls'], 'cache_hits': run['cache_hits'],
+            'cache_misses': run['cache_misses'],
+        } for run in reversed(runs)])
+        st.dataframe(recent, use_container_width=True, hide_index=True)
+        if last:
+            with st.expander(f"Span breakdown of the previous rerun ({last['label']})"):
+                st.dataframe(pd.DataFrame([{
+                    'span': "↳ " * depth + name, 'start_ms': round(start, 2), 'duration_ms': round(duration, 2)
+                } for name, depth, start, duration in last['spans']]), use_container_width=True, hide_index=True)
+    
+    st.markdown("### ⚙️ Background workers")
+    col1, col2 = st.columns(2)
+    with col1:
+        st.caption("Cache refresh")
+        st.json(refresh_worker.stats())
+    with col2:
+        st.caption("Google Sheets outbox")
+        st.json(outbox_flusher.stats() if outbox_flusher is not None else {'mirror': 'off'})
+    if snapshot_store is not None:
+        st.caption("Snapshots")
+        st.json(snapshot_store.stats())
+    if cluster is not None:
+        st.caption("Cluster (shared table versions, leader lease)")
+        st.json(cluster.stats())
+    if getattr(backend, 'mirror', None) is not None:
+        st.caption("Google Sheets client (single-flight, token bucket, 429 retries)")
+        st.json(backend.mirror.client.stats())
+    
+    col1, col2 = st.columns(2)
+    col1.download_button("⬇️ Export JSON", tracer.to_json(), "coaching_erp_metrics.json",
+                         "application/json", use_container_width=True)
+    col2.download_button("⬇️ Export Prometheus", tracer.to_prometheus(), "coaching_erp_metrics.prom",
+                         "text/plain", use_container_width=True)
 
 # ================= MAIN APP =================
 
+def start_services():
+    """Open storage and start the background workers (each is created once per process).
+
+    Deferred until after login so the login page never waits on SQLite or Google Sheets.
+    The summary store is created here too: its methods resolve these globals in the
+    namespace of the run that first built it, which must be one with services started.
+    """
+    global backend, cluster, sync_engine, outbox_flusher, refresh_worker, snapshot_store, summary_store
+    backend = init_storage()
+    cluster = init_cluster()
+    sync_engine = init_sync_engine()
+    outbox_flusher = init_outbox_flusher()
+    refresh_worker = init_refresh_worker()
+    snapshot_store = init_snapshot_store()
+    summary_store = init_summary_store()
+
 def main():
+    with tracer.rerun() as run:
+        render(run)
+
+def render(run):
     if not st.session_state.logged_in:
+        run['label'] = "Login"
         login_page()
     else:
+        start_services()
         col1, col2, col3 = st.columns([2, 3, 1])
         
         with col1:
             st.markdown(f"### 👋 Welcome, **{st.session_state.user}**")
         
+        with col2:
+            if outbox_flusher is not None:
+                queue = outbox_flusher.stats()
+                if queue['parked']:
+                    st.warning(f"⚠️ {queue['parked']} change(s) could not be copied to Google Sheets: {queue['last_error']}")
+                elif queue['queued']:
+                    st.caption(f"⏳ {queue['queued']} change(s) waiting to sync to Google Sheets")
+        
         with col3:
             if st.button("🚪 Logout", use_container_width=True):
                 st.session_state.logged_in = False
                 st.session_state.user = None
-                clear_cache()
                 st.rerun()
         
         st.markdown("---")
         
-        tabs = st.tabs(["🏠 Overview", "🎓 Students", "💰 Payments", "📉 Expenses", "💼 Investments", "📊 Analytics"])
-        
-        with tabs[0]:
-            overview_page()
-        with tabs[1]:
-            students_page()
-        with tabs[2]:
-            payments_page()
-        with tabs[3]:
-            expenses_page()
-        with tabs[4]:
-            investments_page()
-        with tabs[5]:
-            analytics_page()
+        # Only the selected page's function runs on each rerun
+        page = st.navigation([
+            st.Page(overview_page, title="Overview", icon="🏠", default=True),
+            st.Page(students_page, title="Students", icon="🎓"),
+            st.Page(payments_page, title="Payments", icon="💰"),
+            st.Page(expenses_page, title="Expenses", icon="📉"),
+            st.Page(investments_page, title="Investments", icon="💼"),
+            st.Page(analytics_page, title="Analytics", icon="📊"),
+        ] + ([st.Page(diagnostics_page, title="Diagnostics", icon="🩺")]
+             if st.session_state.user in ADMINS else []), position="top")
+        run['label'] = page.title
+        page.run()
+
+def cli(argv=None):
+    """Maintenance commands: python coaching_erp_optimized.py reconcile [--repair]"""
+    parser = argparse.ArgumentParser(description="Coaching ERP maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+    reconcile = commands.add_parser("reconcile", help="Report (and repair) stored paid totals that drift from the payments ledger")
+    reconcile.add_argument("--repair", action="store_true", help="Overwrite the stored totals with the ledger values")
+    args = parser.parse_args(argv)
+    
+    if args.command == "reconcile":
+        drift = reconcile_paid(repair=args.repair)
+        if drift.empty:
+            print("No drift: stored paid totals match the payments ledger.")
+        else:
+            print(drift.to_string(index=False))
+            print(f"{len(drift)} student(s) {'repaired' if args.repair else 'drifted (run with --repair to fix)'}.")
+        if args.repair and outbox_flusher is not None:
+            outbox_flusher.flush()
+
+# Imported as a library or run as a command there is no login step. Receipt worker
+# processes (spawn) re-run this script as __mp_main__ and must not open storage.
+if not st.runtime.exists() and __name__ != "__mp_main__":
+    start_services()
 
 if __name__ == "__main__":
-    main()
+    if st.runtime.exists():
+        main()
+    else:
+        cli()
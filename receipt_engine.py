@@ -0,0 +1,141 @@
+"""Receipt rendering engine for the Coaching ERP.
+
+Styles and the table layout are built once per process, receipt numbers are
+derived from the payment id, and batches render across a process pool into a
+ZIP (one PDF per receipt) or into a single multi-page PDF. reportlab is imported
+on the first render, so importing this module for receipt_number stays cheap.
+
+Benchmark:  python receipt_engine.py --count 500 --workers 4
+"""
+import argparse
+import multiprocessing
+import os
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+
+COL_WIDTHS = [150, 300]
+CHUNK_SIZE = 25  # Receipts per worker task
+
+def receipt_number(payment_id):
+    """Deterministic receipt number for a payment"""
+    return f"RCP-{int(payment_id):06d}"
+
+@lru_cache(maxsize=1)
+def receipt_styles():
+    """(title style, body style, table style), built once per process"""
+    from reportlab.platypus import TableStyle
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.lib import colors
+    styles = getSampleStyleSheet()
+    table_style = TableStyle([
+        ('BACKGROUND', (0, 0), (0, -1), colors.HexColor('#667eea')),
+        ('TEXTCOLOR', (0, 0), (0, -1), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica'),
+        ('FONTSIZE', (0, 0), (-1, -1), 12),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
+        ('TOPPADDING', (0, 0), (-1, -1), 12),
+        ('GRID', (0, 0), (-1, -1), 1, colors.grey),
+        ('BOX', (0, 0), (-1, -1), 2, colors.HexColor('#667eea')),
+    ])
+    return styles["Title"], styles["Normal"], table_style
+
+def receipt_story(receipt):
+    """Flowables for one receipt.
+
+    receipt: dict with payment_id, name, course, phone, amount, mode, date (display string)
+    """
+    from reportlab.platypus import Paragraph, Spacer, Table
+    title_style, body_style, table_style = receipt_styles()
+    data = [
+        ["Receipt ID:", receipt_number(receipt['payment_id'])],
+        ["Student Name:", str(receipt['name'])],
+        ["Course:", str(receipt['course'])],
+        ["Phone:", str(receipt['phone'])],
+        ["Amount Paid:", f"₹ {float(receipt['amount']):.2f}"],
+        ["Payment Mode:", str(receipt['mode']).upper()],
+        ["Date:", str(receipt['date'])],
+    ]
+    table = Table(data, colWidths=COL_WIDTHS)
+    table.setStyle(table_style)
+    return [
+        Paragraph("<b>COACHING FEE RECEIPT</b>", title_style),
+        Spacer(1, 30),
+        table,
+        Spacer(1, 40),
+        Paragraph("<i>Thank you for your payment!</i>", body_style),
+    ]
+
+def _build(story):
+    from reportlab.platypus import SimpleDocTemplate
+    from reportlab.lib.pagesizes import A4
+    buf = BytesIO()
+    SimpleDocTemplate(buf, pagesize=A4).build(story)
+    return buf.getvalue()
+
+def render_receipt(receipt):
+    """One receipt as PDF bytes"""
+    return _build(receipt_story(receipt))
+
+def render_combined_pdf(receipts):
+    """All receipts in a single multi-page PDF (one page each)"""
+    from reportlab.platypus import PageBreak
+    story = []
+    for receipt in receipts:
+        if story:
+            story.append(PageBreak())
+        story.extend(receipt_story(receipt))
+    return _build(story)
+
+def _render_chunk(receipts):
+    return [(f"{receipt_number(r['payment_id'])}.pdf", render_receipt(r)) for r in receipts]
+
+def iter_rendered(receipts, workers=None):
+    """Yield (filename, pdf bytes) in input order, rendering across processes"""
+    receipts = list(receipts)
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(receipts) <= CHUNK_SIZE:
+        yield from _render_chunk(receipts)
+        return
+    chunks = [receipts[i:i + CHUNK_SIZE] for i in range(0, len(receipts), CHUNK_SIZE)]
+    # spawn: the app process runs server threads, which fork does not handle safely
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks)), mp_context=context) as pool:
+        for rendered in pool.map(_render_chunk, chunks):
+            yield from rendered
+
+def render_receipts_zip(receipts, workers=None):
+    """ZIP archive with one PDF per receipt"""
+    buf = BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as archive:
+        for filename, pdf in iter_rendered(receipts, workers):
+            archive.writestr(filename, pdf)
+    return buf.getvalue()
+
+def benchmark(count=200, workers=None):
+    """Receipts per second for single, combined-PDF and parallel ZIP rendering"""
+    receipts = [{
+        'payment_id': i, 'name': f"Student {i}", 'course': "JEE", 'phone': "9876543210",
+        'amount': 1500 + i, 'mode': "upi", 'date': "01-04-2025",
+    } for i in range(1, count + 1)]
+    results = {}
+    for label, run in [
+        ("single", lambda: [render_receipt(r) for r in receipts]),
+        ("combined_pdf", lambda: render_combined_pdf(receipts)),
+        ("zip_parallel", lambda: render_receipts_zip(receipts, workers)),
+    ]:
+        start = time.perf_counter()
+        run()
+        results[label] = count / (time.perf_counter() - start)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark receipt rendering")
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    for label, rate in benchmark(args.count, args.workers).items():
+        print(f"{label:>14}: {rate:8.1f} receipts/s")
@@ -0,0 +1,69 @@
+"""Offline fixtures: a temporary SQLite store, optionally mirrored to a fake spreadsheet.
+
+The app starts its services on import; the environment below keeps that start
+offline (no Sheets mirror, no cluster channel, no snapshots) and every test then
+swaps in its own backend and summary store.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(TESTS), TESTS]
+os.environ["COACHING_ERP_SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(), "import.db")
+os.environ["COACHING_ERP_SHEETS_MIRROR"] = "off"
+os.environ["COACHING_ERP_CLUSTER_POLL"] = "off"
+os.environ.pop("COACHING_ERP_SNAPSHOT_DIR", None)
+
+import coaching_erp_optimized as app  # noqa: E402
+from fakesheets import FakeSpreadsheet  # noqa: E402
+
+
+def use_backend(monkeypatch, backend):
+    """Point the app's module globals at `backend` with empty caches"""
+    monkeypatch.setattr(app, 'backend', backend)
+    monkeypatch.setattr(app, 'summary_store', app.SummaryStore())
+    monkeypatch.setattr(app, 'snapshot_store', None)
+    monkeypatch.setattr(app, 'cluster', None)
+    monkeypatch.setattr(app, 'outbox_flusher', None)
+    app.shared_cache.clear()
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "erp.db")
+
+
+@pytest.fixture
+def local(monkeypatch, db_path):
+    """The app running on SQLite alone"""
+    backend = app.SQLiteBackend(db_path)
+    use_backend(monkeypatch, backend)
+    return backend
+
+
+@pytest.fixture
+def spreadsheet():
+    return FakeSpreadsheet(app.SHEET_HEADERS)
+
+
+@pytest.fixture
+def mirror(spreadsheet):
+    return app.GoogleSheetsBackend(lambda: spreadsheet.worksheets,
+                                   app.SheetsClient(per_minute=10 ** 6, burst=10 ** 6))
+
+
+@pytest.fixture
+def mirrored(monkeypatch, db_path, mirror):
+    """The app on SQLite with its writes queued for the fake spreadsheet"""
+    backend = app.MirroredBackend(app.SQLiteBackend(db_path), mirror)
+    use_backend(monkeypatch, backend)
+    return backend
+
+
+@pytest.fixture
+def flusher(mirrored):
+    """Outbox flusher whose thread never runs on its own; tests call flush()"""
+    return app.OutboxFlusher(mirrored.primary, mirrored.mirror, leader=lambda: False)
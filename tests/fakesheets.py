@@ -0,0 +1,109 @@
+"""In-memory stand-in for the gspread spreadsheet/worksheet calls the mirror makes."""
+import re
+from collections import Counter
+
+
+def _col(letters):
+    number = 0
+    for letter in letters:
+        number = number * 26 + ord(letter) - 64
+    return number
+
+
+def _letters(col):
+    letters = ""
+    while col:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def _parse(a1):
+    """'sheet'!A2:H or 'sheet'!A5 -> (sheet, row1, col1, row2 or None, col2)"""
+    name, cells = a1.split('!')
+    start, _, end = cells.replace('$', '').partition(':')
+    c1, r1 = re.fullmatch(r"([A-Z]+)(\d*)", start).groups()
+    c2, r2 = re.fullmatch(r"([A-Z]+)(\d*)", end or start).groups()
+    r1 = int(r1 or 1)
+    r2 = int(r2) if r2 else (r1 if not end else None)
+    return name.strip("'"), r1, _col(c1), r2, _col(c2)
+
+
+class FakeSpreadsheet:
+    """Worksheets keyed by title; rows are lists of cell values, row 1 the header"""
+
+    def __init__(self, headers):
+        self.calls = Counter()
+        self.worksheets = {name: FakeWorksheet(self, name, [list(columns)]) for name, columns in headers.items()}
+
+    def rows(self, sheet_name):
+        return self.worksheets[sheet_name].rows
+
+    def values_batch_get(self, ranges, params=None):
+        self.calls['values_batch_get'] += 1
+        out = []
+        for a1 in ranges:
+            name, r1, c1, r2, c2 = _parse(a1)
+            rows = self.worksheets[name].rows
+            values = [[str(v) for v in rows[r - 1][c1 - 1:c2]] if r <= len(rows) else []
+                      for r in range(r1, (r2 or len(rows)) + 1)]
+            while values and not any(values[-1]):
+                values.pop()
+            out.append({'range': a1, 'values': values} if values else {'range': a1})
+        return {'valueRanges': out}
+
+    def values_batch_update(self, body):
+        self.calls['values_batch_update'] += 1
+        for data in body['data']:
+            name, r1, c1, _, _ = _parse(data['range'])
+            for i, row in enumerate(data['values']):
+                for j, value in enumerate(row):
+                    self.worksheets[name].set(r1 + i, c1 + j, value)
+
+    def values_append(self, a1, params=None, body=None):
+        """INSERT_ROWS: rows go right after the table that starts at A1"""
+        self.calls['values_append'] += 1
+        name = _parse(a1)[0]
+        rows = self.worksheets[name].rows
+        end = 0
+        while end < len(rows) and any(str(v) != '' for v in rows[end]):
+            end += 1
+        values = [list(row) for row in body['values']]
+        rows[end:end] = values
+        last = f"{_letters(len(values[0]))}{end + len(values)}"
+        return {'updates': {'updatedRange': f"'{name}'!A{end + 1}:{last}"}}
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, title, rows):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.rows = rows
+
+    def set(self, row, col, value):
+        while len(self.rows) < row:
+            self.rows.append([])
+        cells = self.rows[row - 1]
+        while len(cells) < col:
+            cells.append('')
+        cells[col - 1] = value
+
+    def col_values(self, col):
+        self.spreadsheet.calls['col_values'] += 1
+        values = [str(row[col - 1]) if len(row) >= col else '' for row in self.rows]
+        while values and values[-1] == '':
+            values.pop()
+        return values
+
+    def acell(self, label):
+        self.spreadsheet.calls['acell'] += 1
+        _, row, col, _, _ = _parse(f"'{self.title}'!{label}")
+        cells = self.rows[row - 1] if row <= len(self.rows) else []
+
+        class Cell:
+            value = str(cells[col - 1]) if col <= len(cells) else None
+        return Cell
+
+    def delete_rows(self, start, end=None):
+        self.spreadsheet.calls['delete_rows'] += 1
+        del self.rows[start - 1:end or start]
@@ -0,0 +1,46 @@
+"""Cross-process invalidation between app processes sharing one SQLite file."""
+import os
+import subprocess
+import sys
+
+from conftest import TESTS, app
+
+WRITER = """
+import coaching_erp_optimized as app
+student = app.add_student("Bilal", "9000000002", "NEET", 7000)
+app.add_payment(student, 500.0, 'cash')
+"""
+
+
+def write_from_another_process(db_path):
+    env = dict(os.environ, COACHING_ERP_SQLITE_PATH=db_path, PYTHONPATH=os.path.dirname(TESTS))
+    subprocess.run([sys.executable, "-c", WRITER], env=env, check=True, capture_output=True)
+
+
+def test_other_process_writes_invalidate_the_cache(local, db_path):
+    channel = app.ClusterChannel(local, app.cluster_changed, poll=3600)
+    app.add_student("Asha", "9000000001", "JEE", 5000)
+    assert len(app.get_students_df()) == 1
+    assert channel.check() == set()  # Own writes already patched the cache
+
+    write_from_another_process(db_path)
+
+    assert channel.check() == {'students', 'payments'}
+    assert app.get_students_df()['name'].tolist() == ['Asha', 'Bilal']
+    assert app.get_financial_summary().total_income == 500.0
+
+
+def test_new_leader_resets_the_mirror_index(mirrored, mirror):
+    local = mirrored.primary
+    first = app.ClusterChannel(local, app.cluster_changed, 3600, app.cluster_elected)
+    second = app.ClusterChannel(local, app.cluster_changed, 3600, app.cluster_elected)
+    mirror.row_index('students')  # Row numbers cached while the first process led
+    assert 'students' in mirror._row_index
+    assert (first.leader, second.leader) == (True, False)
+
+    with local.connection() as conn:  # The first process stopped renewing its lease
+        conn.execute("UPDATE leases SET expires = 0")
+    second.check()
+
+    assert second.leader
+    assert 'students' not in mirror._row_index
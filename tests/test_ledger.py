@@ -0,0 +1,95 @@
+"""The incrementally patched summary, the payments ledger and students.paid must agree."""
+from conftest import app
+
+
+def rollups(summary):
+    """Comparable view of a FinancialSummary (a delete leaves zero entries behind)"""
+    out = {}
+    for name, value in vars(summary).items():
+        if isinstance(value, dict):
+            value = {str(k): round(float(v), 6) for k, v in value.items() if abs(v) > 1e-9}
+        else:
+            value = round(float(value), 6)
+        out[name] = value
+    return out
+
+
+def assert_consistent():
+    summary = app.get_financial_summary()
+    app.shared_cache.clear()
+    rebuilt = app.FinancialSummary.build(app.get_payments_df(), app.get_expenses_df(),
+                                         app.get_investments_df(), app.get_students_df())
+    assert rollups(summary) == rollups(rebuilt)
+    stored = {row['id']: float(row['paid'] or 0) for row in app.backend.fetch_all('students')}
+    assert stored == {sid: rebuilt.paid_by_student.get(sid, 0.0) for sid in stored}
+    assert app.reconcile_paid().empty
+
+
+def test_add_and_delete_patch_the_summary_without_rebuilding(local, monkeypatch):
+    first = app.add_student("Asha", "9000000001", "JEE", 5000)
+    second = app.add_student("Bilal", "9000000002", "NEET", 7000)
+    app.get_financial_summary()
+    builds = []
+    build = app.FinancialSummary.build
+    monkeypatch.setattr(app.FinancialSummary, 'build', lambda *a: builds.append(1) or build(*a))
+
+    payment = app.add_payment(first, 1200.0, 'cash')
+    app.add_payment(first, 300.0, 'upi')
+    app.add_payment(second, 700.0, 'cash')
+    app.add_expense("Rent", 2000.0, "Rent")
+    app.add_investment("Tapan", 5000.0, "seed")
+    assert app.delete_row('payments', payment)
+
+    summary = app.get_financial_summary()
+    assert builds == []
+    assert summary.paid_by_student[first] == 300.0
+    assert summary.total_income == 1000.0
+    assert_consistent()
+
+
+def test_bulk_import_keeps_stored_paid_current(local):
+    first = app.add_student("Asha", "9000000001", "JEE", 5000)
+    second = app.add_student("Bilal", "9000000002", "NEET", 7000)
+    app.get_financial_summary()
+    records = [{'student_id': str(first), 'amount': '100', 'mode': 'cash'},
+               {'student_id': str(second), 'amount': '250.5', 'mode': 'UPI'},
+               {'student_id': str(first), 'amount': '50', 'mode': 'cash'},
+               {'student_id': '999', 'amount': '10', 'mode': 'cash'}]
+
+    imported, errors = app.bulk_import('payments', records)
+
+    assert imported == 3
+    assert errors == [(5, "unknown student 999")]
+    assert app.get_financial_summary().paid_by_student[first] == 150.0
+    assert_consistent()
+
+
+def test_payment_writes_leave_the_students_version_alone(local):
+    student = app.add_student("Asha", "9000000001", "JEE", 5000)
+    before = local.table_versions()
+
+    payment = app.add_payment(student, 500.0, 'cash')
+    app.delete_row('payments', payment)
+
+    after = local.table_versions()
+    assert after['students'] == before['students']
+    assert after['payments'] == before['payments'] + 2
+    assert_consistent()
+
+
+def test_row_already_in_the_cache_rebuilds_the_summary(local, monkeypatch):
+    app.add_expense("Rent", 100.0, "Rent")
+    app.get_financial_summary()
+    append = app.cache_append_rows
+
+    def racing(sheet_name, rows):
+        # Another session cold-loads the sheet between the write and the patch
+        app.invalidate_cache(sheet_name)
+        app.get_expenses_df()
+        return append(sheet_name, rows)
+    monkeypatch.setattr(app, 'cache_append_rows', racing)
+    app.add_expense("Power", 50.0, "Utilities")
+    monkeypatch.setattr(app, 'cache_append_rows', append)
+
+    assert app.get_financial_summary().total_expense == 150.0
+    assert_consistent()
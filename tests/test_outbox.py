@@ -0,0 +1,102 @@
+"""Outbox replay against a fake spreadsheet, including sheets edited by hand."""
+import pytest
+
+from conftest import app
+
+
+def sheet_records(spreadsheet, sheet_name):
+    """{id: row} of the fake sheet, values as the mirror wrote them"""
+    return {int(row[0]): row for row in spreadsheet.rows(sheet_name)[1:] if row and row[0] != ''}
+
+
+def test_flush_mirrors_local_writes(mirrored, flusher, spreadsheet):
+    student = app.add_student("Asha", "9000000001", "JEE", 5000)
+    payment = app.add_payment(student, 1200.0, 'cash')
+    app.add_payment(student, 300.0, 'upi')
+    app.delete_row('payments', payment)
+    app.add_expense("Rent", 2000.0, "Rent")
+
+    flusher.flush()
+
+    assert mirrored.primary.outbox_stats(app.OUTBOX_MAX_ATTEMPTS)['queued'] == 0
+    for sheet_name in ('students', 'payments', 'expenses'):
+        local = {row['id'] for row in mirrored.fetch_all(sheet_name)}
+        assert set(sheet_records(spreadsheet, sheet_name)) == local
+    assert float(sheet_records(spreadsheet, 'students')[student][5]) == 300.0
+
+
+def test_payment_delete_is_one_outbox_entry(mirrored):
+    student = app.add_student("Asha", "9000000001", "JEE", 5000)
+    payment = app.add_payment(student, 1200.0, 'cash')
+
+    app.delete_row('payments', payment)
+
+    _, op = mirrored.primary.outbox_pending(10, app.OUTBOX_MAX_ATTEMPTS)[-1]
+    assert op == {'delete': ['payments', payment], 'updates': [['students', student, 'paid', 0.0]]}
+    assert mirrored.primary.outbox_deleted_ids('payments') == {payment}
+
+
+def test_failed_flush_keeps_entries_and_replays_once(mirrored, flusher, spreadsheet, monkeypatch):
+    app.add_student("Asha", "9000000001", "JEE", 5000)
+
+    def down(*args, **kwargs):
+        raise ConnectionError("network down")
+    monkeypatch.setattr(spreadsheet, 'values_append', down)
+    with pytest.raises(ConnectionError):
+        flusher.flush()
+    assert mirrored.primary.outbox_stats(app.OUTBOX_MAX_ATTEMPTS)['queued'] == 1
+    monkeypatch.undo()
+
+    flusher.flush()
+    row = spreadsheet.rows('students')[1]
+    with mirrored.primary.connection() as conn:  # The same append delivered twice
+        mirrored.primary._enqueue(conn, {'appends': [['students', row]], 'updates': []})
+    flusher.flush()
+
+    assert [r[0] for r in spreadsheet.rows('students')[1:]] == [row[0]]
+
+
+def test_append_keeps_a_row_added_by_hand(mirrored, flusher, spreadsheet):
+    for i in range(1, 5):
+        app.add_student(f"Student {i}", f"900000000{i}", "JEE", 1000)
+    flusher.flush()
+    spreadsheet.rows('students').append([50, 'Hand', '9000000050', 'NEET', 700, 0, 'active', '2025-01-01'])
+
+    added = app.add_student("Student 5", "9000000005", "JEE", 1000)
+    flusher.flush()
+
+    assert [row[0] for row in spreadsheet.rows('students')[1:]] == [1, 2, 3, 4, 50, added]
+
+
+def test_update_follows_its_row_after_a_delete_by_hand(mirrored, flusher, spreadsheet):
+    for i in range(1, 4):
+        app.add_student(f"Student {i}", f"900000000{i}", "JEE", 1000)
+    flusher.flush()
+    del spreadsheet.rows('students')[1]  # Student 1 removed in the sheet
+
+    app.add_payment(2, 300.0, 'cash')
+    flusher.flush()
+
+    paid = {row_id: float(row[5]) for row_id, row in sheet_records(spreadsheet, 'students').items()}
+    assert paid == {2: 300.0, 3: 0.0}
+
+
+def test_update_of_a_missing_row_stays_queued_until_parked(mirrored, flusher, spreadsheet):
+    student = app.add_student("Asha", "9000000001", "JEE", 5000)
+    flusher.flush()
+    local = mirrored.primary
+    with local.connection() as conn:
+        local._enqueue(conn, {'appends': [], 'updates': [['students', 42, 'paid', 10.0]]})
+        local._enqueue(conn, {'appends': [], 'updates': [['students', student, 'paid', 300.0]]})
+
+    with pytest.raises(LookupError):
+        flusher.flush()
+
+    assert float(sheet_records(spreadsheet, 'students')[student][5]) == 300.0
+    assert [op['updates'][0][1] for _, op in local.outbox_pending(10, app.OUTBOX_MAX_ATTEMPTS)] == [42]
+    for _ in range(app.OUTBOX_MAX_ATTEMPTS - 1):
+        with pytest.raises(LookupError):
+            flusher.flush()
+    flusher.flush()  # Parked: no longer retried
+    stats = local.outbox_stats(app.OUTBOX_MAX_ATTEMPTS)
+    assert (stats['queued'], stats['parked']) == (1, 1)